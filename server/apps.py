@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ServerConfig(AppConfig):
     name = 'server'
+
+    def ready(self):
+        # Connects the signal handlers that keep the proxy routing table and interned keys fresh
+        from . import interning, routing
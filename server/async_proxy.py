@@ -0,0 +1,201 @@
+"""
+Non-blocking counterpart of ProxyView for the ASGI entry point. Upstream calls are made with aiohttp, so a proxied
+request waiting on a slow in-world script costs a coroutine rather than a worker thread. Database lookups still use
+the ORM and run in the default executor.
+"""
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+from django.conf import settings
+from django.core.urlresolvers import resolve, Resolver404
+from django.db import close_old_connections
+
+from .breaker import CircuitOpen, breakers
+from .metrics import outbound_metrics
+from .models import ServerProxy
+from .proxy_cache import proxy_cache
+from .routing import routing_table
+from .singleflight import AsyncSingleFlight
+from .views import json_error
+from . import outbound
+
+_client = None
+_flights = AsyncSingleFlight()
+
+
+def get_client():
+    global _client
+    loop = asyncio.get_event_loop()
+    if _client is None or _client[0] is not loop:
+        connect_timeout, read_timeout = outbound.get_timeout()
+        connector = aiohttp.TCPConnector(limit=getattr(settings, 'SERVER_ASYNC_HTTP_LIMIT', 1000), ssl=False)
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        # Same no-cookies policy as the synchronous session in server.outbound
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout, cookie_jar=aiohttp.DummyCookieJar())
+        _client = (loop, session)
+    return _client[1]
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client[1].close()
+        _client = None
+
+
+class ResponseTooLarge(Exception):
+    def __init__(self, status):
+        super(ResponseTooLarge, self).__init__(status)
+        self.status = status
+
+
+async def fetch(url, timeout=None, chunk_size=65536):
+    """
+    Returns (status, content type, body). Raises ResponseTooLarge once the body passes
+    SERVER_PROXY_MAX_RESPONSE_SIZE bytes rather than buffering all of it.
+    """
+    kwargs = {}
+    if timeout is not None:
+        kwargs['timeout'] = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+    max_size = getattr(settings, 'SERVER_PROXY_MAX_RESPONSE_SIZE', 10 * 1024 * 1024)
+    async with get_client().get(url, **kwargs) as response:
+        if response.content_length is not None and response.content_length > max_size:
+            raise ResponseTooLarge(response.status)
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(chunk_size):
+            body += chunk
+            if len(body) > max_size:
+                raise ResponseTooLarge(response.status)
+        return response.status, response.headers.get('Content-Type', 'text/plain'), bytes(body)
+
+
+def get_route(proxy_name):
+    # Executor threads live outside Django's request cycle, so do its connection housekeeping here
+    close_old_connections()
+    try:
+        return routing_table.lookup(proxy_name)
+    except ServerProxy.DoesNotExist:
+        return None
+
+
+def json_response(payload):
+    return 200, 'application/json', json.dumps(payload).encode('utf-8')
+
+
+async def call_upstream(route, full_path):
+    """
+    Makes one upstream request through the server's breaker. Raises CircuitOpen, or whatever the request raised.
+    """
+    breakers.before_call(route.server_id)
+    start = time.perf_counter()
+    try:
+        logging.debug("Requesting: " + full_path)
+        response = await fetch(full_path, route.get_timeout())
+    except asyncio.CancelledError:
+        # A cancelled call says nothing about the server, but a half-open trial it held must be given back or the
+        # breaker never lets another call through. Caught on its own since it's a BaseException from Python 3.8 on.
+        breakers.release(route.server_id)
+        raise
+    except ResponseTooLarge as ex:
+        # The server did answer, so this doesn't count against its breaker
+        breakers.record_success(route.server_id)
+        outbound_metrics.record(time.perf_counter() - start, route.server_id, route.proxy_name, status_code=ex.status)
+        raise
+    except Exception as ex:
+        breakers.record_failure(route.server_id)
+        outbound_metrics.record(time.perf_counter() - start, route.server_id, route.proxy_name,
+                                timeout=isinstance(ex, asyncio.TimeoutError), error=True)
+        raise
+    breakers.record_success(route.server_id)
+    outbound_metrics.record(time.perf_counter() - start, route.server_id, route.proxy_name, status_code=response[0])
+    return response
+
+
+async def proxy(proxy_name, user_query):
+    loop = asyncio.get_event_loop()
+    route = await loop.run_in_executor(None, get_route, proxy_name)
+    if route is None:
+        return json_response(json_error('Unknown proxy'))
+
+    full_path = route.get_url(user_query)
+
+    def fetch_upstream():
+        return call_upstream(route, full_path)
+
+    # Same layering as ProxyView
+    if getattr(settings, 'SERVER_PROXY_COALESCE', True):
+        fetch_uncoalesced = fetch_upstream
+
+        def fetch_upstream():
+            return _flights.do(('proxy', full_path), fetch_uncoalesced)
+
+    try:
+        if route.cache_ttl:
+            return await proxy_cache.get_async((proxy_name, full_path), route.cache_ttl, fetch_upstream)
+        return await fetch_upstream()
+    except CircuitOpen:
+        logging.debug("Circuit open for server %s, not proxying", route.server_id)
+        return json_response(json_error('Unable to contact server'))
+    except ResponseTooLarge:
+        return json_response(json_error('Response too large'))
+    except Exception:
+        logging.exception("Failed to connect to server for async proxy")
+        return json_response(json_error('Unable to contact server'))
+
+
+def resolve_proxy(path):
+    try:
+        match = resolve(path)
+    except Resolver404:
+        return None
+    if match.view_name != 'server:proxy':
+        return None
+    return match.kwargs['proxy_name'], match.kwargs.get('user_query') or ''
+
+
+async def send_response(send, status, content_type, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode('latin-1')), (b'content-length', str(len(body)).encode('ascii'))],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_client()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def make_application(fallback=None):
+    """
+    ASGI 3 application serving the proxy route. Every other request goes to fallback, or gets a 404 if there is none.
+    """
+    async def application(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await lifespan(receive, send)
+
+        route = resolve_proxy(scope['path']) if scope['type'] == 'http' else None
+        if route is None:
+            if fallback is not None:
+                return await fallback(scope, receive, send)
+            if scope['type'] == 'http':
+                await send_response(send, 404, 'text/plain', b'Not found')
+            return
+
+        if scope['method'] != 'GET':
+            return await send_response(send, 405, 'text/plain', b'Invalid method')
+
+        status, content_type, body = await proxy(*route)
+        await send_response(send, status, content_type, body)
+
+    return application
@@ -0,0 +1,113 @@
+import threading
+import time
+
+from django.conf import settings
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class Breaker(object):
+    __slots__ = ('state', 'failures', 'opened_at', 'trial_in_flight')
+
+    def __init__(self):
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+
+class BreakerRegistry(object):
+    """
+    Per-server circuit breakers for outbound calls. After SERVER_BREAKER_THRESHOLD consecutive failures a server's
+    breaker opens and calls fail fast with CircuitOpen. Once SERVER_BREAKER_RESET_TIMEOUT seconds have passed a single
+    trial call is let through (half-open): success closes the breaker, failure opens it for another period.
+
+    Only servers with failures are tracked, and the state is per process.
+    """
+    def __init__(self, threshold=None, reset_timeout=None):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get_threshold(self):
+        return self.threshold or getattr(settings, 'SERVER_BREAKER_THRESHOLD', 5)
+
+    def get_reset_timeout(self):
+        if self.reset_timeout is not None:
+            return self.reset_timeout
+        return getattr(settings, 'SERVER_BREAKER_RESET_TIMEOUT', 30)
+
+    def before_call(self, key):
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker is None or breaker.state == STATE_CLOSED:
+                return
+            if breaker.state == STATE_OPEN and time.monotonic() - breaker.opened_at >= self.get_reset_timeout():
+                breaker.state = STATE_HALF_OPEN
+            if breaker.state == STATE_HALF_OPEN and not breaker.trial_in_flight:
+                breaker.trial_in_flight = True
+                return
+        raise CircuitOpen(key)
+
+    def record_success(self, key):
+        with self.lock:
+            self.breakers.pop(key, None)
+
+    def record_failure(self, key):
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker is None:
+                breaker = self.breakers[key] = Breaker()
+            breaker.failures += 1
+            breaker.trial_in_flight = False
+            if breaker.state == STATE_HALF_OPEN or breaker.failures >= self.get_threshold():
+                breaker.state = STATE_OPEN
+                breaker.opened_at = time.monotonic()
+
+    def release(self, key):
+        """
+        Gives back a half-open trial whose call ended without an outcome (was cancelled), so the next call can try.
+        """
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker is not None:
+                breaker.trial_in_flight = False
+
+    def call(self, key, fn, *args, **kwargs):
+        """
+        Runs fn through key's breaker. Any exception fn raises counts as a failure and is re-raised.
+        """
+        self.before_call(key)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure(key)
+            raise
+        self.record_success(key)
+        return result
+
+    def reset(self, key):
+        self.record_success(key)
+
+    def clear(self):
+        with self.lock:
+            self.breakers.clear()
+
+    def states(self):
+        now = time.monotonic()
+        with self.lock:
+            return {key: {
+                'state': breaker.state,
+                'failures': breaker.failures,
+                'open_for': None if breaker.opened_at is None else now - breaker.opened_at,
+            } for key, breaker in self.breakers.items()}
+
+
+breakers = BreakerRegistry()
@@ -0,0 +1,157 @@
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Server
+from . import outbound
+from .breaker import CircuitOpen, breakers
+
+
+# Seconds run_probes() waits for a freed worker to start the next queued probe
+PICKUP_GRACE = 0.1
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Process-wide probe pool, so concurrent bulk status requests share one cap of SERVER_HEALTH_CHECK_CONCURRENCY
+    probes in flight instead of each starting their own.
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=getattr(settings, 'SERVER_HEALTH_CHECK_CONCURRENCY', 20))
+    return _executor
+
+
+def probe(server, timeout=None):
+    """
+    Makes a single /Base/Status call to server. Returns (status, latency in seconds, checked_on).
+    """
+    checked_on = timezone.now()
+    start = time.perf_counter()
+    try:
+        server_request = breakers.call(server.pk, outbound.get, server.address + "?path=/Base/Status", timeout=timeout,
+                                       server_id=server.pk)
+        if server_request.status_code == 200 and server_request.text == 'OK.':
+            status = Server.STATUS_ONLINE
+        else:
+            status = Server.STATUS_OFFLINE
+    except CircuitOpen:
+        status = Server.STATUS_UNREACHABLE
+    except Exception as ex:
+        logging.warning("Failed to contact server %s for health check: %s", server.pk, ex)
+        status = Server.STATUS_UNREACHABLE
+    return status, time.perf_counter() - start, checked_on
+
+
+def record(server, status, latency, checked_on):
+    server.last_status = status
+    server.last_latency = latency
+    server.last_checked_on = checked_on
+    # update() rather than save() so a health check never overwrites concurrent edits or bumps updated_on
+    Server.objects.filter(pk=server.pk).update(last_status=status, last_latency=latency, last_checked_on=checked_on)
+
+
+def check_server(server):
+    status, latency, checked_on = probe(server)
+    record(server, status, latency, checked_on)
+    return status
+
+
+def get_checkable_servers():
+    return Server.objects.filter(enabled=True).exclude(type=Server.TYPE_UNREGISTERED)
+
+
+def run_probes(executor, probe_server, servers, deadline=None):
+    """
+    Returns a (status, latency, checked_on) per server, or None where the probe didn't finish in time. With a deadline
+    every probe gets that many seconds from when it actually starts, not from when it was queued. Once no probe is
+    running within its deadline, servers still queued behind the pool's cap are given up on without being contacted.
+    """
+    if deadline is None:
+        return list(executor.map(probe_server, servers))
+
+    condition = threading.Condition()
+    started = {}
+    results = {}
+
+    def run(index, server):
+        with condition:
+            started[index] = time.monotonic()
+            condition.notify_all()
+        result = probe_server(server)
+        with condition:
+            results[index] = result
+            condition.notify_all()
+
+    pending = [executor.submit(run, index, server) for index, server in enumerate(servers)]
+    with condition:
+        while len(results) < len(servers):
+            now = time.monotonic()
+            running = [started[index] + deadline for index in started
+                       if index not in results and started[index] + deadline > now]
+            if running:
+                condition.wait(min(running) - now)
+            elif len(started) < len(servers):
+                # Give a worker that just finished a moment to pick up the next queued probe
+                num_started = len(started)
+                condition.wait(PICKUP_GRACE)
+                if len(started) == num_started:
+                    break
+            else:
+                break
+
+        # Probes can't be interrupted; late ones finish in their worker and their results are dropped
+        for future in pending:
+            future.cancel()
+        return [results.get(index) for index in range(len(servers))]
+
+
+def check_all(servers=None, concurrency=None, timeout=None, deadline=None):
+    """
+    Probes servers (every enabled, registered server by default) concurrently and stores the results. With no
+    concurrency given the shared pool is used. Probes run in worker threads; all database writes happen on the
+    calling thread. timeout applies to each connect and read, and deadline to each probe as a whole (see
+    run_probes). Servers whose probe missed the deadline keep their stored state and are left out of the result.
+    """
+    if servers is None:
+        servers = get_checkable_servers()
+    servers = list(servers)
+    if not servers:
+        return {}
+
+    probe_server = functools.partial(probe, timeout=timeout)
+    if concurrency is None:
+        results = run_probes(get_executor(), probe_server, servers, deadline)
+    else:
+        executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(servers))))
+        try:
+            results = run_probes(executor, probe_server, servers, deadline)
+        finally:
+            # Don't wait for probes that already missed the deadline
+            executor.shutdown(wait=deadline is None)
+
+    statuses = {}
+    for server, result in zip(servers, results):
+        if result is None:
+            continue
+        status, latency, checked_on = result
+        record(server, status, latency, checked_on)
+        statuses[server.pk] = status
+    return statuses
+
+
+def is_stale(server):
+    if server.last_checked_on is None:
+        return True
+    max_age = getattr(settings, 'SERVER_HEALTH_CHECK_MAX_AGE', 300)
+    return (timezone.now() - server.last_checked_on).total_seconds() > max_age
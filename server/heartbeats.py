@@ -0,0 +1,105 @@
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .breaker import breakers
+from .models import Server
+from .routing import routing_table
+
+
+# Written along with a new address, since the stored health check was against the old one
+MOVED_SERVER_FIELDS = {'last_status': Server.STATUS_UNKNOWN, 'last_checked_on': None}
+
+
+def reset_moved_servers(server_ids):
+    """
+    Drops the process state kept for the old addresses of servers that update() has moved, which sends no signals:
+    their circuit breakers and the cached routes to them. The update itself sets MOVED_SERVER_FIELDS.
+    """
+    server_ids = list(server_ids)
+    for server_id in server_ids:
+        breakers.reset(server_id)
+    if server_ids:
+        routing_table.invalidate()
+
+
+class HeartbeatBuffer(object):
+    """
+    Write-behind buffer for UpdateView. Validated updates are kept in memory per server, with later updates
+    replacing earlier ones, and a background thread writes them all in one transaction every
+    SERVER_HEARTBEAT_FLUSH_INTERVAL milliseconds. Anything still pending is flushed when the process exits.
+    """
+    def __init__(self, interval=None):
+        self.interval = interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def add(self, server_id, fields, moved=False):
+        """
+        Queues fields to be written to server_id, replacing any update still pending for it. moved marks an
+        address change, which sticks until the flush even if later updates replace the fields.
+        """
+        with self.lock:
+            previous = self.pending.get(server_id)
+            self.pending[server_id] = (fields, moved or (previous is not None and previous[1]))
+        self.start()
+
+    def flush(self):
+        with self.lock:
+            batch = self.pending
+            self.pending = {}
+        if not batch:
+            return 0
+
+        try:
+            with transaction.atomic():
+                for server_id, (fields, moved) in batch.items():
+                    if moved:
+                        fields = dict(fields, **MOVED_SERVER_FIELDS)
+                    Server.objects.filter(pk=server_id).update(**fields)
+        except Exception:
+            logging.exception("Failed to flush %d buffered heartbeats", len(batch))
+            with self.lock:
+                # Keep anything that wasn't superseded while this batch was being written
+                for server_id, (fields, moved) in batch.items():
+                    newer = self.pending.get(server_id)
+                    self.pending[server_id] = (fields if newer is None else newer[0], moved or (newer is not None and newer[1]))
+            return 0
+
+        reset_moved_servers(server_id for server_id, (fields, moved) in batch.items() if moved)
+        return len(batch)
+
+    def get_interval(self):
+        interval = self.interval or getattr(settings, 'SERVER_HEARTBEAT_FLUSH_INTERVAL', 500)
+        return interval / 1000.0
+
+    def run(self):
+        while not self.stopping.wait(self.get_interval()):
+            self.flush()
+            close_old_connections()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self.run, name='heartbeat-flush', daemon=True)
+                self.thread.start()
+                atexit.register(self.stop)
+
+    def stop(self):
+        thread = self.thread
+        if thread is not None:
+            self.stopping.set()
+            thread.join()
+            self.thread = None
+        self.flush()
+
+
+heartbeat_buffer = HeartbeatBuffer()
@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Shard, Region, Agent
+
+
+class InternCache(object):
+    """
+    Process-local LRU of natural keys (shard name, region name, agent key and name) to primary keys. Misses go
+    through get_or_create, so the first registration from a region pays the lookups and the rest pay none.
+
+    Shards, regions and agents are never deleted in normal operation; local deletes and edits clear the cache
+    through signals.
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            pk = self.entries.get(key)
+            if pk is not None:
+                self.entries.move_to_end(key)
+            return pk
+
+    def put(self, key, pk):
+        with self.lock:
+            self.entries[key] = pk
+            self.entries.move_to_end(key)
+            max_entries = self.max_entries or getattr(settings, 'SERVER_INTERN_CACHE_SIZE', 10000)
+            while len(self.entries) > max_entries:
+                self.entries.popitem(last=False)
+
+    def resolve(self, key, model, **lookup):
+        pk = self.get(key)
+        if pk is None:
+            try:
+                instance, created = model.objects.get_or_create(**lookup)
+            except IntegrityError:
+                # Lost a creation race that get_or_create could not recover from; the winner's row is there now
+                instance = model.objects.get(**lookup)
+            pk = instance.pk
+            self.put(key, pk)
+        return pk
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+intern_cache = InternCache()
+
+
+def resolve_location(shard_name, region_name, owner_name, owner_key):
+    """
+    Returns the (shard_id, region_id, owner_id) for a set of parsed LSL headers, creating rows as needed.
+    """
+    shard_id = intern_cache.resolve(('shard', shard_name), Shard, name=shard_name)
+    region_id = intern_cache.resolve(('region', shard_id, region_name), Region, shard_id=shard_id, name=region_name)
+    owner_id = intern_cache.resolve(('agent', shard_id, owner_key, owner_name), Agent, shard_id=shard_id, name=owner_name, uuid=owner_key)
+    return shard_id, region_id, owner_id
+
+
+@receiver(post_save, sender=Shard)
+@receiver(post_save, sender=Region)
+@receiver(post_save, sender=Agent)
+def _on_interned_saved(sender, created=False, **kwargs):
+    # New rows can't be in the cache yet; only edits can make an entry wrong
+    if not created:
+        intern_cache.clear()
+
+
+@receiver(post_delete, sender=Shard)
+@receiver(post_delete, sender=Region)
+@receiver(post_delete, sender=Agent)
+def _on_interned_deleted(sender, **kwargs):
+    intern_cache.clear()
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.core.urlresolvers import resolve, reverse
+from django.test import RequestFactory
+
+from server import async_proxy
+from server.models import Agent, Region, Server, ServerProxy, Shard
+from server.routing import routing_table
+
+
+# asyncio.current_task() and all_tasks() only exist from Python 3.7, and the Task classmethods they replace were
+# removed in 3.9
+current_task_of_loop = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+all_tasks_of_loop = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+
+
+class FakeServer(object):
+    """
+    Stand-in for an in-world server.lsl HTTP-in URL: answers every request with 'OK.' after a fixed delay.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(self.start())
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    async def start(self):
+        return await asyncio.start_server(self.handle, '127.0.0.1', 0)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                await reader.readuntil(b'\r\n\r\n')
+                await asyncio.sleep(self.delay)
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 3\r\n\r\nOK.')
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        # Drop keep-alive connections the clients left open
+        current_task = current_task_of_loop()
+        tasks = [task for task in all_tasks_of_loop() if task is not current_task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class Command(BaseCommand):
+    help = 'Compares concurrent proxy throughput of ProxyView (thread per request) and the ASGI application in ' \
+           'server.async_proxy against a local fake in-world server. The proxy rows it needs are removed afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Number of proxied requests')
+        parser.add_argument('--delay', type=float, default=0.2, help='Seconds the fake in-world script takes to answer')
+        parser.add_argument('--workers', type=int, default=8, help='Worker threads available to ProxyView')
+
+    def handle(self, *args, **options):
+        num_requests = options['requests']
+        with FakeServer(options['delay']) as fake_server:
+            server_proxy = self.create_proxy('http://127.0.0.1:{}/'.format(fake_server.port))
+            try:
+                # Load the route up front so neither path is timed on a database lookup
+                routing_table.lookup(server_proxy.proxy_name)
+                # A distinct upstream path per request, so coalescing doesn't merge them
+                paths = [reverse('server:proxy', kwargs={'proxy_name': server_proxy.proxy_name, 'user_query': str(i)})
+                         for i in range(num_requests)]
+
+                sync_time = self.run_sync(paths, options['workers'])
+                self.report('ProxyView ({} workers)'.format(options['workers']), num_requests, sync_time)
+
+                async_time = self.run_async(paths)
+                self.report('ASGI', num_requests, async_time)
+            finally:
+                self.delete_proxy(server_proxy)
+
+    def create_proxy(self, address):
+        name = 'benchmark-' + uuid.uuid4().hex
+        shard = Shard.objects.create(name=name)
+        region = Region.objects.create(name=name, shard=shard)
+        agent = Agent.objects.create(name='Benchmark', uuid=str(uuid.uuid4()), shard=shard)
+        server = Server.objects.create(object_key=str(uuid.uuid4()), object_name=name, type=Server.TYPE_DEFAULT,
+                                       shard=shard, region=region, owner=agent, address=address,
+                                       private_token=Server.new_token(), public_token=Server.new_token(),
+                                       position_x=0, position_y=0, position_z=0, enabled=False)
+        return ServerProxy.objects.create(proxy_name=name, server=server, forced_path='?path=/Base/Status&request=',
+                                          allow_user_query=True)
+
+    def delete_proxy(self, server_proxy):
+        server = server_proxy.server
+        server_proxy.delete()
+        server.delete()
+        Agent.objects.filter(pk=server.owner_id).delete()
+        Region.objects.filter(pk=server.region_id).delete()
+        Shard.objects.filter(pk=server.shard_id).delete()
+
+    def report(self, name, num_requests, elapsed):
+        self.stdout.write('{}: {} requests in {:.3f} s, {:.1f} requests/s'.format(name, num_requests, elapsed, num_requests / elapsed))
+
+    def run_sync(self, paths, workers):
+        request_factory = RequestFactory()
+
+        def get(path):
+            match = resolve(path)
+            return match.func(request_factory.get(path), *match.args, **match.kwargs).content
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(get, paths))
+        elapsed = time.perf_counter() - start
+        assert results.count(b'OK.') == len(paths), results[:1]
+        return elapsed
+
+    def run_async(self, paths):
+        application = async_proxy.make_application()
+
+        async def get(path):
+            messages = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                messages.append(message)
+
+            await application({'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': []},
+                              receive, send)
+            return messages[-1]['body']
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            start = time.perf_counter()
+            results = loop.run_until_complete(asyncio.gather(*[get(path) for path in paths]))
+            elapsed = time.perf_counter() - start
+            loop.run_until_complete(async_proxy.close_client())
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+        assert results.count(b'OK.') == len(paths), results[:1]
+        return elapsed
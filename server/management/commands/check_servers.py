@@ -0,0 +1,30 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from server import health
+from server.models import Server
+
+
+class Command(BaseCommand):
+    help = 'Probes every enabled server and stores its status for StatusView. Runs forever unless --once is given.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, help='Seconds between check rounds. Defaults to SERVER_HEALTH_CHECK_INTERVAL.')
+        parser.add_argument('--concurrency', type=int, help='Maximum probes in flight. Defaults to SERVER_HEALTH_CHECK_CONCURRENCY.')
+        parser.add_argument('--once', action='store_true', help='Run a single round and exit')
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or getattr(settings, 'SERVER_HEALTH_CHECK_INTERVAL', 60)
+        while True:
+            start = time.monotonic()
+            close_old_connections()
+            statuses = health.check_all(concurrency=options['concurrency'])
+            online = sum(1 for status in statuses.values() if status == Server.STATUS_ONLINE)
+            self.stdout.write('Checked {} servers in {:.2f}s, {} online'.format(len(statuses), time.monotonic() - start, online))
+
+            if options['once']:
+                return
+            time.sleep(max(0.0, interval - (time.monotonic() - start)))
@@ -0,0 +1,82 @@
+import threading
+from collections import Counter
+
+# Upper bounds in seconds of the latency histogram buckets, in the style of Prometheus 'le' buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Series(object):
+    __slots__ = ('buckets', 'count', 'total', 'status_codes', 'timeouts', 'errors')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.status_codes = Counter()
+        self.timeouts = 0
+        self.errors = 0
+
+    def record(self, latency, status_code=None, timeout=False, error=False):
+        index = 0
+        while index < len(LATENCY_BUCKETS) and latency > LATENCY_BUCKETS[index]:
+            index += 1
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += latency
+        if status_code is not None:
+            self.status_codes[status_code] += 1
+        if timeout:
+            self.timeouts += 1
+        elif error:
+            self.errors += 1
+
+    def as_dict(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], self.buckets):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'buckets': buckets,
+            'status_codes': {str(status_code): count for status_code, count in self.status_codes.items()},
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+        }
+
+
+class OutboundMetrics(object):
+    """
+    Process-local latency histograms, status code counts and timeout/error counts for outbound calls, kept per
+    server and per proxy. Timeouts are counted separately from other errors.
+    """
+    def __init__(self):
+        self.servers = {}
+        self.proxies = {}
+        self.lock = threading.Lock()
+
+    def record(self, latency, server_id=None, proxy_name=None, status_code=None, timeout=False, error=False):
+        with self.lock:
+            for series_map, key in [(self.servers, server_id), (self.proxies, proxy_name)]:
+                if key is None:
+                    continue
+                series = series_map.get(key)
+                if series is None:
+                    series = series_map[key] = Series()
+                series.record(latency, status_code, timeout, error)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'servers': {server_id: series.as_dict() for server_id, series in self.servers.items()},
+                'proxies': {proxy_name: series.as_dict() for proxy_name, series in self.proxies.items()},
+            }
+
+    def clear(self):
+        with self.lock:
+            self.servers.clear()
+            self.proxies.clear()
+
+
+outbound_metrics = OutboundMetrics()
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 19:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0006_serverproxy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serverproxy',
+            name='cache_ttl',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
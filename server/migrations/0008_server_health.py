@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 19:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0007_serverproxy_cache_ttl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='server',
+            name='last_checked_on',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='server',
+            name='last_latency',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='server',
+            name='last_status',
+            field=models.IntegerField(choices=[(0, 'Unknown'), (1, 'Online'), (2, 'Offline'), (3, 'Unreachable')], default=0),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 19:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0008_server_health'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='serverproxy',
+            name='connect_timeout',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='serverproxy',
+            name='read_timeout',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -1,7 +1,7 @@
 import binascii
 import os
 
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.core.validators import RegexValidator
 from django.contrib.auth.models import User
 
@@ -59,33 +59,86 @@ class Server(models.Model):
         (TYPE_MAP, 'Map'),
     )
 
+    STATUS_UNKNOWN = 0
+    STATUS_ONLINE = 1
+    STATUS_OFFLINE = 2
+    STATUS_UNREACHABLE = 3
+    STATUS_CHOICES = (
+        (STATUS_UNKNOWN, 'Unknown'),
+        (STATUS_ONLINE, 'Online'),
+        (STATUS_OFFLINE, 'Offline'),
+        (STATUS_UNREACHABLE, 'Unreachable'),
+    )
+
+    TOKEN_FIELDS = ('private_token', 'public_token')
+    TOKEN_ATTEMPTS = 10
+
+    @staticmethod
+    def new_token():
+        return binascii.hexlify(os.urandom(16)).decode('utf-8')
+
+    @staticmethod
+    def generate_tokens(count, fields=TOKEN_FIELDS):
+        """
+        Mints tokens for count servers, checking them all against existing servers with one query per attempt.
+        Returns a list of {field: token} dicts, or None if no unique set was found within TOKEN_ATTEMPTS attempts.
+        """
+        token_sets = [{field: Server.new_token() for field in fields} for i in range(count)]
+        for i in range(Server.TOKEN_ATTEMPTS):
+            tokens = [token for token_set in token_sets for token in token_set.values()]
+            lookup = models.Q()
+            for field in fields:
+                lookup |= models.Q(**{field + '__in': tokens})
+            taken = set()
+            for row in Server.objects.filter(lookup).values_list(*fields):
+                taken.update(row)
+
+            # Tokens also have to be unique within the batch, whichever field they end up in
+            seen = set()
+            collisions = 0
+            for token_set in token_sets:
+                for field, token in token_set.items():
+                    if token in taken or token in seen:
+                        token_set[field] = Server.new_token()
+                        collisions += 1
+                    seen.add(token_set[field])
+            if not collisions:
+                return token_sets
+        return None
+
     @staticmethod
     def generate_private_token():
-        token = None
-        for i in range(0, 10):
-            token = binascii.hexlify(os.urandom(16)).decode('utf-8')
-            if Server.objects.filter(private_token=token).count() != 0:
-                token = None
-            else:
-                break
-        return token
+        token_sets = Server.generate_tokens(1, ['private_token'])
+        return None if token_sets is None else token_sets[0]['private_token']
 
     @staticmethod
     def generate_public_token():
-        token = None
-        for i in range(0, 10):
-            token = binascii.hexlify(os.urandom(16)).decode('utf-8')
-            if Server.objects.filter(public_token=token).count() != 0:
-                token = None
-            else:
-                break
-        return token
+        token_sets = Server.generate_tokens(1, ['public_token'])
+        return None if token_sets is None else token_sets[0]['public_token']
 
     def regenerate_private_token(self):
-        self.private_token = self.generate_private_token()
+        self.private_token = self.new_token()
 
     def regenerate_public_token(self):
-        self.public_token = self.generate_public_token()
+        self.public_token = self.new_token()
+
+    def save_with_new_tokens(self, fields=TOKEN_FIELDS):
+        """
+        Assigns fresh tokens and saves, relying on the unique constraints instead of checking for collisions first.
+        Retries with new tokens only when the IntegrityError names one of the token fields. Returns False if every
+        attempt collided.
+        """
+        for i in range(self.TOKEN_ATTEMPTS):
+            for field in fields:
+                setattr(self, field, self.new_token())
+            try:
+                with transaction.atomic():
+                    self.save()
+                return True
+            except IntegrityError as ex:
+                if not any(field in str(ex) for field in fields):
+                    raise
+        return False
 
     object_key = models.CharField(max_length=36, unique=True, validators=[
         RegexValidator(
@@ -109,9 +162,31 @@ class Server(models.Model):
     enabled = models.BooleanField()
     created_on = models.DateTimeField(auto_now_add=True)
     updated_on = models.DateTimeField(auto_now=True)
+    last_status = models.IntegerField(choices=STATUS_CHOICES, default=STATUS_UNKNOWN)
+    last_latency = models.FloatField(null=True, blank=True)
+    last_checked_on = models.DateTimeField(null=True, blank=True)
 
 class ServerProxy(models.Model):
     proxy_name = models.CharField(max_length=255, unique=True)
     server = models.ForeignKey(Server, on_delete=models.DO_NOTHING)
     forced_path = models.CharField(null=True, max_length=255)
     allow_user_query = models.BooleanField(default=False)
+    cache_ttl = models.PositiveIntegerField(default=0)
+    # Outbound timeouts in seconds for this proxy; None falls back to SERVER_HTTP_CONNECT_TIMEOUT/READ_TIMEOUT
+    connect_timeout = models.FloatField(null=True, blank=True)
+    read_timeout = models.FloatField(null=True, blank=True)
+
+    def get_url(self, user_query):
+        url = self.server.address
+        if self.forced_path is not None:
+            url = url + self.forced_path
+        if self.allow_user_query:
+            url = url + user_query
+        return url
+
+
+class RoutingVersion(models.Model):
+    """
+    Single row counting changes to proxy routes, so every process can tell when its routing table is stale.
+    """
+    version = models.PositiveIntegerField(default=0)
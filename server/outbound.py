@@ -0,0 +1,67 @@
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .metrics import outbound_metrics
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def create_session():
+    """
+    One shared session for every outbound call to in-world servers. The adapter keeps a connection pool per host
+    so repeated calls to the same simulator reuse keep-alive connections instead of paying TCP/TLS setup each time.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=getattr(settings, 'SERVER_HTTP_POOL_HOSTS', 100),
+                          pool_maxsize=getattr(settings, 'SERVER_HTTP_POOL_SIZE', 10))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.verify = False
+    # Servers belong to different users, so never carry cookies from one to another
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = create_session()
+    return _session
+
+
+def get_timeout():
+    return getattr(settings, 'SERVER_HTTP_CONNECT_TIMEOUT', 5), getattr(settings, 'SERVER_HTTP_READ_TIMEOUT', 30)
+
+
+def get(url, timeout=None, server_id=None, proxy_name=None, **kwargs):
+    """
+    GET through the shared session, recording the latency and outcome under server_id and proxy_name when given.
+    """
+    start = time.perf_counter()
+    try:
+        response = get_session().get(url, timeout=timeout or get_timeout(), **kwargs)
+    except requests.Timeout:
+        outbound_metrics.record(time.perf_counter() - start, server_id, proxy_name, timeout=True)
+        raise
+    except Exception:
+        outbound_metrics.record(time.perf_counter() - start, server_id, proxy_name, error=True)
+        raise
+    outbound_metrics.record(time.perf_counter() - start, server_id, proxy_name, status_code=response.status_code)
+    return response
+
+
+@receiver(setting_changed)
+def _on_setting_changed(setting, **kwargs):
+    global _session
+    if setting.startswith('SERVER_HTTP_'):
+        _session = None
@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class CacheEntry(object):
+    __slots__ = ('response', 'expires', 'refreshing')
+
+    def __init__(self, response, expires):
+        self.response = response
+        self.expires = expires
+        self.refreshing = False
+
+
+class ProxyCache(object):
+    """
+    Process-local TTL cache for proxied responses with stale-while-revalidate. Once an entry expires the first
+    caller refreshes it while everyone else keeps getting the stale response, so each key costs at most one
+    upstream request per TTL no matter how many clients poll it. Only 200 responses are cached.
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, ttl, fetch):
+        response, entry = self.lookup(key)
+        if response is not None:
+            return response
+        try:
+            response = fetch()
+        except:
+            self.abandon(entry)
+            raise
+        self.store(key, ttl, response, entry)
+        return response
+
+    async def get_async(self, key, ttl, fetch):
+        """
+        get() for the async proxy: fetch is a coroutine function. The lock is never held across an await.
+        """
+        response, entry = self.lookup(key)
+        if response is not None:
+            return response
+        try:
+            response = await fetch()
+        except:
+            self.abandon(entry)
+            raise
+        self.store(key, ttl, response, entry)
+        return response
+
+    def lookup(self, key):
+        """
+        Returns (response, None) when there is a response to serve, otherwise (None, entry) with entry being the
+        expired entry this caller now refreshes, or None on a miss.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                if time.monotonic() < entry.expires or entry.refreshing:
+                    return entry.response, None
+                entry.refreshing = True
+        return None, entry
+
+    def abandon(self, entry):
+        if entry is not None:
+            with self.lock:
+                entry.refreshing = False
+
+    def store(self, key, ttl, response, entry):
+        with self.lock:
+            if response[0] == 200:
+                self.entries[key] = CacheEntry(response, time.monotonic() + ttl)
+                self.entries.move_to_end(key)
+                max_entries = self.max_entries or getattr(settings, 'SERVER_PROXY_CACHE_SIZE', 1000)
+                while len(self.entries) > max_entries:
+                    self.entries.popitem(last=False)
+            elif entry is not None:
+                entry.refreshing = False
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+proxy_cache = ProxyCache()
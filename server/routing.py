@@ -0,0 +1,139 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.db.models import F
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .models import RoutingVersion, Server, ServerProxy
+from . import outbound
+
+
+class Route(namedtuple('Route', ['proxy_name', 'server_id', 'address', 'forced_path', 'allow_user_query', 'cache_ttl',
+                                 'connect_timeout', 'read_timeout'])):
+    __slots__ = ()
+
+    @classmethod
+    def from_proxy(cls, server_proxy):
+        return cls(server_proxy.proxy_name, server_proxy.server_id, server_proxy.server.address,
+                   server_proxy.forced_path, server_proxy.allow_user_query, server_proxy.cache_ttl,
+                   server_proxy.connect_timeout, server_proxy.read_timeout)
+
+    def get_timeout(self):
+        connect_timeout, read_timeout = outbound.get_timeout()
+        if self.connect_timeout is not None:
+            connect_timeout = self.connect_timeout
+        if self.read_timeout is not None:
+            read_timeout = self.read_timeout
+        return connect_timeout, read_timeout
+
+    def get_url(self, user_query):
+        # Same rules as ServerProxy.get_url
+        url = self.address
+        if self.forced_path is not None:
+            url = url + self.forced_path
+        if self.allow_user_query:
+            url = url + user_query
+        return url
+
+
+class RoutingTable(object):
+    """
+    Process-local LRU of proxy name to Route, so ProxyView resolves known proxies without touching the database.
+
+    Local saves and deletes of ServerProxy and Server rows clear the table through signals. They also bump the
+    RoutingVersion row, which other processes compare against at most once every SERVER_ROUTING_VERSION_CHECK_INTERVAL
+    seconds. Queryset update() calls send no signals, so code changing routing fields that way has to call
+    invalidate() itself.
+    """
+    def __init__(self, max_entries=None, check_interval=None):
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self.routes = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.version = None
+        self.next_check = 0.0
+
+    def check_version(self):
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        check_interval = self.check_interval
+        if check_interval is None:
+            check_interval = getattr(settings, 'SERVER_ROUTING_VERSION_CHECK_INTERVAL', 1)
+        self.next_check = now + check_interval
+
+        version = RoutingVersion.objects.filter(pk=1).values_list('version', flat=True).first()
+        if version != self.version:
+            with self.lock:
+                self.routes.clear()
+                self.generation += 1
+                self.version = version
+
+    def lookup(self, proxy_name):
+        """
+        Returns the Route for proxy_name, raising ServerProxy.DoesNotExist or MultipleObjectsReturned like a get().
+        """
+        self.check_version()
+        with self.lock:
+            route = self.routes.get(proxy_name)
+            if route is not None:
+                self.routes.move_to_end(proxy_name)
+                return route
+            generation = self.generation
+
+        route = Route.from_proxy(ServerProxy.objects.select_related('server').get(proxy_name=proxy_name))
+
+        with self.lock:
+            # Don't store a route loaded from before an invalidation that happened while it was being read
+            if generation == self.generation:
+                self.routes[proxy_name] = route
+                max_entries = self.max_entries or getattr(settings, 'SERVER_ROUTING_TABLE_SIZE', 1000)
+                while len(self.routes) > max_entries:
+                    self.routes.popitem(last=False)
+        return route
+
+    def clear(self):
+        with self.lock:
+            self.routes.clear()
+            self.generation += 1
+
+    def invalidate(self):
+        # The database is the one store every worker and the ASGI process share. The bump is part of the caller's
+        # transaction, so other processes only see it once the change itself is committed.
+        self.clear()
+        if not RoutingVersion.objects.filter(pk=1).update(version=F('version') + 1):
+            routing_version, created = RoutingVersion.objects.get_or_create(pk=1, defaults={'version': 1})
+            if not created:
+                # Another process created the row first
+                RoutingVersion.objects.filter(pk=1).update(version=F('version') + 1)
+
+
+routing_table = RoutingTable()
+
+
+@receiver(post_save, sender=ServerProxy)
+@receiver(post_delete, sender=ServerProxy)
+@receiver(post_delete, sender=Server)
+def _on_route_changed(sender, **kwargs):
+    routing_table.invalidate()
+
+
+@receiver(post_init, sender=Server)
+def _on_server_loaded(sender, instance, **kwargs):
+    # Read from __dict__ so a deferred address isn't fetched just to be remembered
+    instance._routed_address = instance.__dict__.get('address')
+
+
+@receiver(post_save, sender=Server)
+def _on_server_saved(sender, instance, created=False, update_fields=None, **kwargs):
+    # New servers can't be the target of a proxy yet, and only the address is part of a route. Registrations and
+    # other saves leave the table alone instead of clearing it in every process.
+    if update_fields is not None and 'address' not in update_fields:
+        return
+    if not created and (instance._routed_address is None or instance.address != instance._routed_address):
+        routing_table.invalidate()
+    instance._routed_address = instance.address
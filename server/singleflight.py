@@ -0,0 +1,137 @@
+import asyncio
+import functools
+import hashlib
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import outbound
+
+
+MISSING = object()
+
+
+class Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the function and every caller that arrives
+    while it is in flight waits for and shares its result (or exception).
+    """
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+
+class AsyncSingleFlight(object):
+    """
+    Coroutine counterpart of SingleFlight for the ASGI proxy. Each flight runs as a task of its own, so a caller that
+    is cancelled (say because its client went away) doesn't cancel the call for everyone else sharing it.
+    """
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, fn):
+        loop = asyncio.get_event_loop()
+        call = self.calls.get(key)
+        if call is None or call[0] is not loop:
+            task = asyncio.ensure_future(fn())
+            call = self.calls[key] = (loop, task)
+            task.add_done_callback(functools.partial(self._done, key, call))
+        return await asyncio.shield(call[1])
+
+    def _done(self, key, call, task):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+        if not task.cancelled():
+            # Retrieve the exception so it isn't reported as unhandled when every caller has been cancelled
+            task.exception()
+
+
+class CacheSingleFlight(object):
+    """
+    Cross-process coalescing through a shared Django cache backend. The process that wins cache.add() on the lock
+    key runs the function and publishes the result under a key unique to that flight; the others poll for it.
+    Waiters that outlive the lock without seeing a result run the function themselves.
+    """
+    poll_interval = 0.05
+
+    def __init__(self, cache, timeout):
+        self.cache = cache
+        self.timeout = timeout
+
+    def do(self, key, fn):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        lock_key = 'singleflight:lock:' + digest
+        flight_id = uuid.uuid4().hex
+
+        if self.cache.add(lock_key, flight_id, self.timeout):
+            try:
+                result = fn()
+                self.cache.set('singleflight:result:{}:{}'.format(digest, flight_id), result, self.timeout)
+                return result
+            finally:
+                self.cache.delete(lock_key)
+
+        deadline = time.monotonic() + self.timeout
+        leader_id = None
+        while time.monotonic() < deadline:
+            current_id = self.cache.get(lock_key)
+            if current_id is not None:
+                leader_id = current_id
+            if leader_id is not None:
+                # The leader publishes before releasing the lock, so check for a result even once the lock is gone
+                result = self.cache.get('singleflight:result:{}:{}'.format(digest, leader_id), MISSING)
+                if result is not MISSING:
+                    return result
+            if current_id is None:
+                break
+            time.sleep(self.poll_interval)
+        return fn()
+
+
+_flights = SingleFlight()
+
+
+def coalesce(key, fn):
+    """
+    Runs fn once per key across concurrent callers in this process and, when SERVER_PROXY_COALESCE_CACHE names a
+    cache alias, across processes sharing that cache.
+    """
+    cache_alias = getattr(settings, 'SERVER_PROXY_COALESCE_CACHE', None)
+    if cache_alias:
+        cache_flight = CacheSingleFlight(caches[cache_alias], sum(outbound.get_timeout()))
+        return _flights.do(key, lambda: cache_flight.do(key, fn))
+    return _flights.do(key, fn)
@@ -1,16 +1,42 @@
+import asyncio
+import datetime
+import hashlib
+import io
+import json
 import requests
+import threading
+import time
+from unittest import mock, skipUnless
 from django.test import LiveServerTestCase
 from django.test import TransactionTestCase, TestCase
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.core.cache.backends.locmem import LocMemCache
 
 from .models import *
+from . import health, outbound, singleflight, views
+from .breaker import BreakerRegistry, CircuitOpen, breakers
+from .heartbeats import HeartbeatBuffer, heartbeat_buffer
+from .interning import InternCache, intern_cache, resolve_location
+from .metrics import outbound_metrics
+from .proxy_cache import ProxyCache, proxy_cache
+from .routing import RoutingTable, routing_table
+from .singleflight import SingleFlight, CacheSingleFlight
+from .views import json_error, json_success
 from .views import JSON_RESULT_ERROR
 from .views import JSON_RESULT_SUCCESS
 from .views import JSON_TAG_RESULT 
 from .views import JSON_TAG_MESSAGE
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 
 def is_json_success(result_json):
     return JSON_TAG_RESULT in result_json and result_json[JSON_TAG_RESULT] == JSON_RESULT_SUCCESS
@@ -259,6 +285,50 @@ class ServerTests(TestCase):
 
         self.assertSequenceEqual(Server.objects.all(), servers)
 
+    def new_server(self, object_key, **kwargs):
+        return Server(object_key=object_key, object_name='Server', type=Server.TYPE_UNREGISTERED, shard=self.first_shard,
+                      region=self.first_region, owner=self.first_agent, address='http://example.com/', position_x=1.23,
+                      position_y=2.34, position_z=3.45, enabled=False, **kwargs)
+
+    def test_save_with_new_tokens(self):
+        """
+        Token collisions must be retried with new tokens; other integrity errors must propagate.
+        """
+        existing_server = self.new_server('00000000-0000-0000-0000-000000000001')
+        self.assertTrue(existing_server.save_with_new_tokens())
+        self.assertNotEqual(existing_server.private_token, existing_server.public_token)
+
+        tokens = iter([existing_server.private_token, '30303030303030303030303030303030',
+                       '44444444444444444444444444444444', '40404040404040404040404040404040'])
+        new_server = self.new_server('00000000-0000-0000-0000-000000000002')
+        with mock.patch.object(Server, 'new_token', side_effect=lambda: next(tokens)):
+            self.assertTrue(new_server.save_with_new_tokens())
+        self.assertEqual((new_server.private_token, new_server.public_token),
+                         ('44444444444444444444444444444444', '40404040404040404040404040404040'))
+        self.assertEqual(Server.objects.count(), 2)
+
+        with mock.patch.object(Server, 'new_token', return_value=existing_server.public_token):
+            self.assertFalse(self.new_server('00000000-0000-0000-0000-000000000003').save_with_new_tokens(['public_token']))
+
+        with self.assertRaises(IntegrityError):
+            self.new_server(existing_server.object_key).save_with_new_tokens()
+
+    def test_generate_tokens(self):
+        """
+        Batch generation must return unique tokens for every server using one query per attempt.
+        """
+        existing_server = self.new_server('00000000-0000-0000-0000-000000000001')
+        existing_server.save_with_new_tokens()
+
+        with self.assertNumQueries(1):
+            token_sets = Server.generate_tokens(100)
+        tokens = [token for token_set in token_sets for token in token_set.values()]
+        self.assertEqual(len(set(tokens)), 200)
+
+        tokens = iter([existing_server.public_token, existing_server.public_token, '30303030303030303030303030303030'])
+        with mock.patch.object(Server, 'new_token', side_effect=lambda: next(tokens)), self.assertNumQueries(3):
+            self.assertEqual(Server.generate_tokens(1, ['public_token']), [{'public_token': '30303030303030303030303030303030'}])
+
 
 class RegisterViewTests(TestCase):
     def post_with_metadata(self, address, server):
@@ -299,6 +369,7 @@ class RegisterViewTests(TestCase):
                                 HTTP_X_SECONDLIFE_SHARD=shard)
 
     def setUp(self):
+        intern_cache.clear()
         self.object_key = '00000000-0000-0000-0000-000000000001'
         self.server_data = {
             'shard': 'Test Shard',
@@ -332,6 +403,32 @@ class RegisterViewTests(TestCase):
         self.assertEquals(first_server.position_z, self.server_data['position_z'])
         self.assertEquals(first_server.type, Server.TYPE_UNREGISTERED)
 
+    def test_interned_location(self):
+        """
+        Registrations from an already seen shard, region and owner must not query those tables again.
+        """
+        self.post_with_metadata(reverse('server:register'), self.server_data)
+        second_server_data = dict(self.server_data, object_key='00000000-0000-0000-0000-000000000002')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post_with_metadata(reverse('server:register'), second_server_data)
+        self.assertTrue(is_json_success(response.json()))
+        for table in [Shard._meta.db_table, Region._meta.db_table, Agent._meta.db_table]:
+            self.assertFalse([query for query in queries.captured_queries if table in query['sql']])
+        # Nothing routes to a new server yet, so registering one leaves the routing version alone
+        self.assertFalse([query for query in queries.captured_queries if RoutingVersion._meta.db_table in query['sql']])
+
+        second_server = Server.objects.get(object_key=second_server_data['object_key'])
+        first_server = Server.objects.get(object_key=self.object_key)
+        self.assertEqual((second_server.shard_id, second_server.region_id, second_server.owner_id),
+                         (first_server.shard_id, first_server.region_id, first_server.owner_id))
+
+        # A renamed owner is a different agent row, as with get_or_create
+        Agent.objects.filter(pk=first_server.owner_id).update(name='renamed resident')
+        intern_cache.clear()
+        third_server_data = dict(self.server_data, object_key='00000000-0000-0000-0000-000000000003', owner_name='renamed resident')
+        self.assertTrue(is_json_success(self.post_with_metadata(reverse('server:register'), third_server_data).json()))
+        self.assertEqual(Server.objects.get(object_key=third_server_data['object_key']).owner_id, first_server.owner_id)
+
     def test_existing_unregistered_server(self):
         # Create create our first server
         new_server_response = self.post_with_metadata(reverse('server:register'), self.server_data)
@@ -454,6 +551,110 @@ class UpdateViewTests(TestCase):
         first_server = Server.objects.first()
         self.assertEquals(first_server.address, new_address)
 
+    def test_update_query_budget(self):
+        """
+        A heartbeat with an unchanged address must authenticate and write in a single query.
+        """
+        with self.assertNumQueries(1):
+            response = post_with_metadata(self.client, reverse('server:update'), self.test_server, {'private_token': self.test_server.private_token, 'address': self.server_data['address']})
+        self.assertTrue(is_json_success(response.json()))
+        self.assertGreater(Server.objects.get(pk=self.test_server.pk).updated_on, self.test_server.updated_on)
+
+    def test_update_new_address(self):
+        """
+        An address change must be written along with a reset of the stored health check and the routing table.
+        """
+        Server.objects.filter(pk=self.test_server.pk).update(last_status=Server.STATUS_ONLINE, last_checked_on=timezone.now())
+        ServerProxy.objects.create(proxy_name='test_server_proxy', server=self.test_server)
+        routing_table.lookup('test_server_proxy')
+
+        new_address = 'http://example.com/new'
+        response = post_with_metadata(self.client, reverse('server:update'), self.test_server, {'private_token': self.test_server.private_token, 'address': new_address})
+        self.assertTrue(is_json_success(response.json()))
+        updated_server = Server.objects.get(pk=self.test_server.pk)
+        self.assertEqual(updated_server.address, new_address)
+        self.assertEqual(updated_server.last_status, Server.STATUS_UNKNOWN)
+        self.assertIsNone(updated_server.last_checked_on)
+        self.assertEqual(routing_table.lookup('test_server_proxy').address, new_address)
+
+    def test_update_errors(self):
+        """
+        Failed updates must still report why they failed.
+        """
+        response = post_with_metadata(self.client, reverse('server:update'), self.test_server, {'private_token': '00000000000000000000000000000000', 'address': self.server_data['address']})
+        self.assertEqual(response.json()[JSON_TAG_MESSAGE], 'Server does not exist')
+
+        Server.objects.filter(pk=self.test_server.pk).update(type=Server.TYPE_UNREGISTERED)
+        response = post_with_metadata(self.client, reverse('server:update'), self.test_server, {'private_token': self.test_server.private_token, 'address': self.server_data['address']})
+        self.assertEqual(response.json()[JSON_TAG_MESSAGE], 'Server not registered')
+
+        self.test_server.object_key = '00000000-0000-0000-0000-000000000009'
+        response = post_with_metadata(self.client, reverse('server:update'), self.test_server, {'private_token': self.test_server.private_token, 'address': self.server_data['address']})
+        self.assertEqual(response.json()[JSON_TAG_MESSAGE], 'Object not registered.')
+
+    def test_invalid_update(self):
+        """
+        Malformed addresses and positions must be rejected before anything is written.
+        """
+        response = post_with_metadata(self.client, reverse('server:update'), self.test_server, {'private_token': self.test_server.private_token, 'address': 'not a url'})
+        self.assertEqual(response.json(), {JSON_TAG_RESULT: JSON_RESULT_ERROR, JSON_TAG_MESSAGE: 'Invalid arguments'})
+        self.assertEqual(Server.objects.get(pk=self.test_server.pk).address, self.server_data['address'])
+
+    def test_write_behind_update(self):
+        """
+        Buffered updates must reach the database on flush, with the latest update per server winning.
+        """
+        new_addresses = ['http://example.com/new_1', 'http://example.com/new_2']
+        breakers.clear()
+        breakers.record_failure(self.test_server.pk)
+        with self.settings(SERVER_HEARTBEAT_WRITE_BEHIND=True), mock.patch.object(heartbeat_buffer, 'start'):
+            for new_address in new_addresses:
+                response = post_with_metadata(self.client, reverse('server:update'), self.test_server, {'private_token': self.test_server.private_token, 'address': new_address})
+                self.assertTrue(is_json_success(response.json()))
+            self.assertEqual(Server.objects.get(pk=self.test_server.pk).address, self.server_data['address'])
+            # Requests are still routed to the old address until the flush, and so keep its breaker
+            self.assertIn(self.test_server.pk, breakers.states())
+
+            # The heartbeat transaction, then the routing version bump for the moved server
+            RoutingVersion.objects.get_or_create(pk=1)
+            with self.assertNumQueries(4):
+                self.assertEqual(heartbeat_buffer.flush(), 1)
+            self.assertEqual(heartbeat_buffer.flush(), 0)
+            self.assertNotIn(self.test_server.pk, breakers.states())
+
+        updated_server = Server.objects.get(pk=self.test_server.pk)
+        self.assertEqual(updated_server.address, new_addresses[-1])
+        self.assertEqual(updated_server.position_x, self.test_server.position_x)
+        self.assertGreater(updated_server.updated_on, self.test_server.updated_on)
+
+    def test_failed_flush(self):
+        """
+        A failed flush must keep its updates for the next one unless newer updates replaced them.
+        """
+        buffer = HeartbeatBuffer()
+        buffer.start = mock.Mock()
+        buffer.add(self.test_server.pk, {'address': 'http://example.com/new_1'}, moved=True)
+        with mock.patch.object(Server.objects, 'filter', side_effect=IntegrityError()):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(buffer.pending, {self.test_server.pk: ({'address': 'http://example.com/new_1'}, True)})
+
+        buffer.add(self.test_server.pk, {'address': 'http://example.com/new_2'})
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(Server.objects.get(pk=self.test_server.pk).address, 'http://example.com/new_2')
+
+    def test_update_resets_breaker(self):
+        """
+        Reporting a new address must close the server's circuit breaker.
+        """
+        breakers.clear()
+        for i in range(10):
+            breakers.record_failure(self.test_server.pk)
+        post_with_metadata(self.client, reverse('server:update'), self.test_server, {'private_token': self.test_server.private_token, 'address': self.server_data['address']})
+        self.assertIn(self.test_server.pk, breakers.states())
+
+        post_with_metadata(self.client, reverse('server:update'), self.test_server, {'private_token': self.test_server.private_token, 'address': 'http://example.com/new'})
+        self.assertNotIn(self.test_server.pk, breakers.states())
+
     def test_invalid_private_token_update(self):
         invalid_private_tokens = [
             self.test_server.public_token,
@@ -471,6 +672,115 @@ class UpdateViewTests(TestCase):
             self.assertEquals(first_server.address, self.server_data['address'])
 
 
+class BulkUpdateViewTests(TestCase):
+    def setUp(self):
+        first_shard = Shard.objects.create(name='Shard A')
+        first_region = Region.objects.create(name='Region A', shard=first_shard)
+        first_agent = Agent.objects.create(name='First Agent', uuid='41f94400-2a3e-408a-9b80-1774724f62af', shard=first_shard)
+        self.servers = []
+        for i in range(1, 4):
+            self.servers.append(Server.objects.create(
+                object_key='00000000-0000-0000-0000-00000000000{}'.format(i),
+                object_name='Server {}'.format(i),
+                type=Server.TYPE_DEFAULT if i < 3 else Server.TYPE_UNREGISTERED,
+                shard=first_shard,
+                region=first_region,
+                owner=first_agent,
+                address='http://example.com/server_{}'.format(i),
+                private_token=str(i) * 32,
+                public_token=str(i) * 16 + '0' * 16,
+                position_x=1.0,
+                position_y=2.0,
+                position_z=3.0,
+                enabled=False,
+                last_status=Server.STATUS_ONLINE
+            ))
+
+    def post_updates(self, updates):
+        return self.client.post(reverse('server:bulk_update'), json.dumps(updates), content_type='application/json')
+
+    def update_for(self, server, **kwargs):
+        update = {'object_key': server.object_key, 'private_token': server.private_token, 'address': server.address, 'position': [4.0, 5.0, 6.0]}
+        update.update(kwargs)
+        return update
+
+    def test_bulk_update(self):
+        """
+        Every item must get its own result, with all valid items authenticated by one query and written by one.
+        """
+        first_server, second_server, unregistered_server = self.servers
+        updates = [
+            self.update_for(first_server),
+            self.update_for(second_server, address='http://example.com/moved', object_name='Renamed'),
+            self.update_for(first_server, private_token=second_server.private_token),
+            self.update_for(first_server, object_key='00000000-0000-0000-0000-000000000009'),
+            self.update_for(unregistered_server),
+            self.update_for(first_server, address='not a url'),
+            {'object_key': first_server.object_key},
+            self.update_for(first_server, position=[7.0, 8.0, 9.0]),
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post_updates(updates)
+        # The moved server also bumps the routing version, which isn't part of the per-item work
+        statements = [query['sql'].split()[0] for query in queries.captured_queries
+                      if RoutingVersion._meta.db_table not in query['sql']]
+        self.assertEqual([statement for statement in statements if statement in ['SELECT', 'UPDATE']], ['SELECT', 'UPDATE'])
+
+        self.assertTrue(is_json_success(response.json()))
+        self.assertEqual(response.json()[JSON_TAG_MESSAGE], [
+            json_success('OK'),
+            json_success('OK'),
+            json_error('Server does not exist'),
+            json_error('Object not registered.'),
+            json_error('Server not registered'),
+            json_error('Invalid arguments'),
+            json_error('One or more missing arguments'),
+            json_success('OK'),
+        ])
+
+        first_server_updated = Server.objects.get(pk=first_server.pk)
+        self.assertEqual((first_server_updated.position_x, first_server_updated.position_y, first_server_updated.position_z), (7.0, 8.0, 9.0))
+        self.assertEqual(first_server_updated.object_name, first_server.object_name)
+        self.assertEqual(first_server_updated.last_status, Server.STATUS_ONLINE)
+        self.assertGreater(first_server_updated.updated_on, first_server.updated_on)
+
+        second_server_updated = Server.objects.get(pk=second_server.pk)
+        self.assertEqual(second_server_updated.address, 'http://example.com/moved')
+        self.assertEqual(second_server_updated.object_name, 'Renamed')
+        self.assertEqual(second_server_updated.last_status, Server.STATUS_UNKNOWN)
+        self.assertEqual(Server.objects.get(pk=unregistered_server.pk).position_x, 1.0)
+
+    def test_batches(self):
+        """
+        Updates must be split into batches without losing any.
+        """
+        with self.settings(SERVER_BULK_UPDATE_BATCH_SIZE=1):
+            response = self.post_updates([self.update_for(server) for server in self.servers[:2]])
+        self.assertEqual(response.json()[JSON_TAG_MESSAGE], [json_success('OK'), json_success('OK')])
+        self.assertEqual(Server.objects.filter(position_x=4.0).count(), 2)
+
+    def test_write_behind(self):
+        """
+        In write-behind mode accepted items must be queued for the heartbeat buffer instead of written.
+        """
+        with self.settings(SERVER_HEARTBEAT_WRITE_BEHIND=True), mock.patch.object(heartbeat_buffer, 'start'):
+            response = self.post_updates([self.update_for(self.servers[0], address='http://example.com/moved')])
+            self.assertEqual(response.json()[JSON_TAG_MESSAGE], [json_success('OK')])
+            self.assertEqual(Server.objects.get(pk=self.servers[0].pk).address, self.servers[0].address)
+            self.assertEqual(heartbeat_buffer.flush(), 1)
+        self.assertEqual(Server.objects.get(pk=self.servers[0].pk).address, 'http://example.com/moved')
+
+    def test_invalid_requests(self):
+        """
+        Malformed and oversized requests must be rejected as a whole.
+        """
+        self.assertTrue(is_json_error(self.client.post(reverse('server:bulk_update'), 'not json', content_type='application/json').json()))
+        self.assertTrue(is_json_error(self.post_updates({'object_key': self.servers[0].object_key}).json()))
+        with self.settings(SERVER_BULK_UPDATE_MAX_ITEMS=1):
+            self.assertTrue(is_json_error(self.post_updates([self.update_for(server) for server in self.servers[:2]]).json()))
+        self.assertEqual(self.post_updates([]).json(), json_success([]))
+
+
 class ConfirmServerView(LiveServerTestCase):
     def setUp(self):
         self.username = 'test_user'
@@ -682,6 +992,7 @@ class RegenerateTokenViewTests(TestCase):
 
 class GetServerStatusViewTests(LiveServerTestCase):
     def setUp(self):
+        breakers.clear()
         self.token_types = ['auth', 'public', 'both']
         self.username = 'test_user'
         self.password = 'asdf'
@@ -742,6 +1053,135 @@ class GetServerStatusViewTests(LiveServerTestCase):
             response = self.client.get(reverse('server:status', kwargs={'public_token': invalid_token}))
             self.assertTrue(is_json_error(response.json()))
 
+    def test_stored_status(self):
+        """
+        Once checked, StatusView must answer from the stored state until it is stale or ?live=1 is passed.
+        """
+        status_url = reverse('server:status', kwargs={'public_token': self.public_token})
+        response = self.client.get(status_url)
+        self.assertTrue(is_json_success(response.json()))
+        self.test_server.refresh_from_db()
+        self.assertEqual(self.test_server.last_status, Server.STATUS_ONLINE)
+        self.assertIsNotNone(self.test_server.last_latency)
+        self.assertIsNotNone(self.test_server.last_checked_on)
+
+        Server.objects.filter(pk=self.test_server.pk).update(address=self.live_server_url + '/some/unknown/url')
+        with mock.patch('server.outbound.get') as outbound_get:
+            response = self.client.get(status_url)
+            self.assertTrue(is_json_success(response.json()))
+            self.assertFalse(outbound_get.called)
+
+        response = self.client.get(status_url, {'live': '1'})
+        self.assertTrue(is_json_error(response.json()))
+        self.assertEqual(response.json()[JSON_TAG_MESSAGE], 'Server offline')
+
+        Server.objects.filter(pk=self.test_server.pk).update(
+            address='http://127.0.0.1:1/', last_checked_on=timezone.now() - datetime.timedelta(days=1))
+        response = self.client.get(status_url)
+        self.assertEqual(response.json()[JSON_TAG_MESSAGE], 'Unable to contact server')
+        self.test_server.refresh_from_db()
+        self.assertEqual(self.test_server.last_status, Server.STATUS_UNREACHABLE)
+
+    def test_check_all(self):
+        """
+        The background checker must probe only enabled servers and store each result.
+        """
+        Server.objects.filter(pk__in=[self.test_server.pk, self.test_server_offline.pk]).update(enabled=True)
+        statuses = health.check_all(concurrency=2)
+        self.assertEqual(statuses, {
+            self.test_server.pk: Server.STATUS_ONLINE,
+            self.test_server_offline.pk: Server.STATUS_OFFLINE,
+        })
+        self.test_server_offline.refresh_from_db()
+        self.assertEqual(self.test_server_offline.last_status, Server.STATUS_OFFLINE)
+
+        Server.objects.filter(pk=self.test_server.pk).update(enabled=False)
+        output = io.StringIO()
+        call_command('check_servers', once=True, stdout=output)
+        self.assertIn('Checked 1 servers', output.getvalue())
+
+    def test_check_all_deadline(self):
+        """
+        A probe still running at its deadline must be dropped without waiting for it, and without storing anything.
+        """
+        release = threading.Event()
+        self.addCleanup(release.set)
+        stored_status = Server.objects.get(pk=self.test_server.pk).last_status
+
+        def probe(server, timeout=None):
+            if server.pk == self.test_server.pk:
+                release.wait(5)
+            return Server.STATUS_ONLINE, 0.01, timezone.now()
+
+        with mock.patch('server.health.probe', probe):
+            for concurrency in [None, 2]:
+                start = time.monotonic()
+                statuses = health.check_all([self.test_server, self.test_server_offline], concurrency=concurrency, deadline=0.2)
+                self.assertLess(time.monotonic() - start, 2)
+                self.assertEqual(statuses, {self.test_server_offline.pk: Server.STATUS_ONLINE})
+
+            # A server queued behind the stuck probe is never contacted, so nothing is reported or stored for it
+            Server.objects.filter(pk=self.test_server_offline.pk).update(last_status=Server.STATUS_OFFLINE)
+            statuses = health.check_all([self.test_server, self.test_server_offline], concurrency=1, deadline=0.2)
+            self.assertEqual(statuses, {})
+            self.assertEqual(Server.objects.get(pk=self.test_server_offline.pk).last_status, Server.STATUS_OFFLINE)
+        self.test_server.refresh_from_db()
+        self.assertEqual(self.test_server.last_status, stored_status)
+
+    def test_check_all_deadline_per_server(self):
+        """
+        Servers queued behind the concurrency cap must get the whole deadline once their own probe starts.
+        """
+        servers = [mock.Mock(pk=i) for i in range(10)]
+
+        def probe(server, timeout=None):
+            time.sleep(0.3)
+            return Server.STATUS_ONLINE, 0.3, timezone.now()
+
+        with mock.patch('server.health.probe', probe), mock.patch('server.health.record'):
+            statuses = health.check_all(servers, concurrency=2, deadline=0.5)
+        self.assertEqual(statuses, {server.pk: Server.STATUS_ONLINE for server in servers})
+
+    def test_bulk_status(self):
+        """
+        The bulk endpoint must report every requested token, or every server of the logged in user by default.
+        """
+        invalid_token = '30303030303030303030303030303030'
+        response = self.client.get(reverse('server:bulk_status'), {'tokens': ','.join([self.public_token, self.public_token_offline, invalid_token])})
+        self.assertTrue(is_json_success(response.json()))
+        statuses = response.json()[JSON_TAG_MESSAGE]
+        self.assertEqual(statuses[self.public_token]['status'], 'online')
+        self.assertIsNotNone(statuses[self.public_token]['latency'])
+        self.assertEqual(statuses[self.public_token_offline]['status'], 'offline')
+        self.assertEqual(statuses[invalid_token], {'status': 'invalid'})
+
+        # Freshly checked servers are answered from the stored state
+        with mock.patch('server.outbound.get') as outbound_get:
+            response = self.client.get(reverse('server:bulk_status'), {'tokens': self.public_token})
+            self.assertEqual(response.json()[JSON_TAG_MESSAGE][self.public_token]['status'], 'online')
+            self.assertFalse(outbound_get.called)
+
+            # Anonymous callers can't force live probes
+            response = self.client.get(reverse('server:bulk_status'), {'tokens': self.public_token, 'live': '1'})
+            self.assertEqual(response.json()[JSON_TAG_MESSAGE][self.public_token]['status'], 'online')
+            self.assertFalse(outbound_get.called)
+
+        response = self.client.get(reverse('server:bulk_status'))
+        self.assertTrue(is_json_error(response.json()))
+
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(reverse('server:bulk_status'))
+        self.assertEqual(set(response.json()[JSON_TAG_MESSAGE]), {self.public_token, self.public_token_offline})
+
+        # The owner can
+        Server.objects.filter(pk=self.test_server.pk).update(address='http://127.0.0.1:1/')
+        response = self.client.get(reverse('server:bulk_status'), {'tokens': self.public_token, 'live': '1'})
+        self.assertEqual(response.json()[JSON_TAG_MESSAGE][self.public_token]['status'], 'unreachable')
+
+        with self.settings(SERVER_BULK_STATUS_MAX_TOKENS=1):
+            response = self.client.get(reverse('server:bulk_status'), {'tokens': ','.join([self.public_token, invalid_token])})
+            self.assertTrue(is_json_error(response.json()))
+
 
 class CreateProxyViewTests(LiveServerTestCase):
     def setUp(self):
@@ -819,6 +1259,30 @@ class CreateProxyViewTests(LiveServerTestCase):
         self.assertEqual(new_proxy.forced_path, '/forced')
         self.assertTrue(new_proxy.allow_user_query)
 
+    def test_timeouts(self):
+        """
+        Per-proxy timeouts must be stored when valid and rejected otherwise.
+        """
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.post(reverse('server:create_proxy'), {
+            'public_token': self.public_token,
+            'proxy_name': 'test_proxy',
+            'connect_timeout': '1.5',
+            'read_timeout': '10'
+        })
+        self.assertTrue(is_json_success(response.json()))
+        new_proxy = ServerProxy.objects.get(proxy_name='test_proxy')
+        self.assertEqual((new_proxy.connect_timeout, new_proxy.read_timeout), (1.5, 10.0))
+
+        for invalid_timeout in ['abc', '0', '-1', '1000']:
+            response = self.client.post(reverse('server:create_proxy'), {
+                'public_token': self.public_token,
+                'proxy_name': 'invalid_proxy',
+                'read_timeout': invalid_timeout
+            })
+            self.assertEqual(response.json(), {JSON_TAG_RESULT: JSON_RESULT_ERROR, JSON_TAG_MESSAGE: 'Invalid timeout'})
+        self.assertFalse(ServerProxy.objects.filter(proxy_name='invalid_proxy').exists())
+
     def test_duplicate_proxy(self):
         self.client.login(username=self.username, password=self.password)
 
@@ -837,6 +1301,7 @@ class CreateProxyViewTests(LiveServerTestCase):
 
 class ProxyView(LiveServerTestCase):
     def setUp(self):
+        breakers.clear()
         self.token_types = ['auth', 'public', 'both']
         self.username = 'test_user'
         self.password = 'asdf'
@@ -930,3 +1395,814 @@ class ProxyView(LiveServerTestCase):
         self.assertEqual(response.json(), {
             'path': reverse('server:debug_proxy', kwargs={'server_name': test_server_proxy.server.object_name}) + '?path=/Map/Custom'
         })
+
+    def test_proxy_streaming(self):
+        """
+        Streaming mode must forward the upstream body, content type and length unchanged and refuse oversized bodies.
+        """
+        test_server_proxy = ServerProxy.objects.create(
+            proxy_name='test_server_proxy',
+            server=self.test_server,
+            forced_path='?path=/Map/',
+        )
+        proxy_url = reverse('server:proxy', kwargs={'proxy_name': test_server_proxy.proxy_name, 'user_query': ''})
+        with self.settings(SERVER_PROXY_STREAMING=True):
+            response = self.client.get(proxy_url)
+            self.assertTrue(response.streaming)
+            content = b''.join(response.streaming_content)
+            self.assertEqual(json.loads(content.decode('utf-8')), {
+                'path': reverse('server:debug_proxy', kwargs={'server_name': test_server_proxy.server.object_name}) + '?path=/Map/'
+            })
+            self.assertEqual(response['Content-Type'], 'application/json')
+
+            upstream = mock.Mock(status_code=201, url='http://example.com/', headers={'Content-Type': 'text/plain', 'Content-Length': '10'})
+            upstream.iter_content.return_value = iter([b'12345', b'67890'])
+            with mock.patch('server.outbound.get', return_value=upstream):
+                response = self.client.get(proxy_url)
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(response['Content-Type'], 'text/plain')
+                self.assertEqual(response['Content-Length'], '10')
+                self.assertEqual(b''.join(response.streaming_content), b'1234567890')
+
+                with self.settings(SERVER_PROXY_MAX_RESPONSE_SIZE=9):
+                    upstream.close.reset_mock()
+                    response = self.client.get(proxy_url)
+                    self.assertEqual(response.json(), {JSON_TAG_RESULT: JSON_RESULT_ERROR, JSON_TAG_MESSAGE: 'Response too large'})
+                    self.assertTrue(upstream.close.called)
+
+            # A malformed length is ignored rather than failing before the connection is released
+            upstream = mock.Mock(status_code=200, url='http://example.com/', headers={'Content-Type': 'text/plain', 'Content-Length': 'ten'})
+            upstream.iter_content.return_value = iter([b'12345', b'67890'])
+            with mock.patch('server.outbound.get', return_value=upstream):
+                response = self.client.get(proxy_url)
+                self.assertFalse(response.has_header('Content-Length'))
+                self.assertEqual(b''.join(response.streaming_content), b'1234567890')
+                self.assertTrue(upstream.close.called)
+
+    def test_stream_upstream_limit(self):
+        """
+        Bodies without a Content-Length must be cut off once they pass the maximum size.
+        """
+        server_request = mock.Mock(url='http://example.com/')
+        server_request.iter_content.return_value = iter([b'12345', b'67890', b'abcde'])
+        self.assertEqual(b''.join(views.stream_upstream(server_request, 12)), b'1234567890')
+        self.assertTrue(server_request.close.called)
+
+
+class ProxyCacheTests(TestCase):
+    def setUp(self):
+        self.cache = ProxyCache(max_entries=2)
+        self.fetches = []
+
+    def fetch(self, response):
+        def fetch():
+            self.fetches.append(response)
+            return response
+        return fetch
+
+    def test_fresh_and_stale(self):
+        """
+        Fresh entries must be served without fetching. Expired entries are refreshed by one caller while concurrent callers get the stale response.
+        """
+        first = (200, 'text/plain', 'first')
+        self.assertEqual(self.cache.get('key', 60, self.fetch(first)), first)
+        self.assertEqual(self.cache.get('key', 60, self.fetch(None)), first)
+        self.assertEqual(self.fetches, [first])
+
+        self.cache.entries['key'].expires = 0
+        second = (200, 'text/plain', 'second')
+
+        def refresh():
+            # Another caller arriving while the refresh is in flight
+            self.assertEqual(self.cache.get('key', 60, self.fetch(None)), first)
+            return self.fetch(second)()
+
+        self.assertEqual(self.cache.get('key', 60, refresh), second)
+        self.assertEqual(self.cache.get('key', 60, self.fetch(None)), second)
+        self.assertEqual(self.fetches, [first, second])
+
+    def test_errors_not_cached(self):
+        """
+        Non-200 responses and failed refreshes must not replace or wedge the cached entry.
+        """
+        error = (500, 'text/plain', 'error')
+        self.cache.get('key', 60, self.fetch(error))
+        self.cache.get('key', 60, self.fetch(error))
+        self.assertEqual(self.fetches, [error, error])
+
+        ok = (200, 'text/plain', 'ok')
+        self.cache.get('key', 60, self.fetch(ok))
+        self.cache.entries['key'].expires = 0
+
+        def failing_fetch():
+            raise requests.ConnectionError()
+
+        with self.assertRaises(requests.ConnectionError):
+            self.cache.get('key', 60, failing_fetch)
+        self.assertEqual(self.cache.get('key', 60, self.fetch(error)), error)
+        self.assertEqual(self.cache.get('key', 60, self.fetch(ok)), ok)
+
+    def test_eviction(self):
+        """
+        The least recently used entry must be evicted beyond max_entries.
+        """
+        for key in ['a', 'b', 'a', 'c']:
+            self.cache.get(key, 60, self.fetch((200, 'text/plain', key)))
+        self.assertEqual(list(self.cache.entries), ['a', 'c'])
+
+
+class CachedProxyViewTests(LiveServerTestCase):
+    def setUp(self):
+        proxy_cache.clear()
+        breakers.clear()
+        first_shard = Shard.objects.create(name='Shard A')
+        first_region = Region.objects.create(name='Region A', shard=first_shard)
+        first_agent = Agent.objects.create(name='First Agent', uuid='41f94400-2a3e-408a-9b80-1774724f62af', shard=first_shard)
+        self.test_server = Server.objects.create(
+            object_key='00000000-0000-0000-0000-000000000001',
+            object_name='Server A',
+            type=Server.TYPE_DEFAULT,
+            shard=first_shard,
+            region=first_region,
+            owner=first_agent,
+            address=self.live_server_url + reverse('server:debug_proxy', kwargs={'server_name': 'Server A'}),
+            private_token='11111111111111111111111111111111',
+            public_token='10101010101010101010101010101010',
+            position_x=4.44,
+            position_y=5.55,
+            position_z=6.66,
+            enabled=False
+        )
+
+    def test_cached_proxy(self):
+        """
+        Proxies with a cache TTL must forward one request per effective upstream path within the TTL.
+        """
+        ServerProxy.objects.create(proxy_name='test_server_proxy', server=self.test_server, forced_path='?path=/Map/', allow_user_query=True, cache_ttl=60)
+        with mock.patch('server.outbound.get', wraps=outbound.get) as outbound_get:
+            for user_query in ['GetAgentList', 'GetAgentList', 'Other', 'GetAgentList']:
+                response = self.client.get(reverse('server:proxy', kwargs={'proxy_name': 'test_server_proxy', 'user_query': user_query}))
+                self.assertEqual(response.json(), {
+                    'path': reverse('server:debug_proxy', kwargs={'server_name': 'Server A'}) + '?path=/Map/' + user_query
+                })
+        self.assertEqual(outbound_get.call_count, 2)
+
+    def test_uncached_proxy(self):
+        """
+        Proxies without a cache TTL must forward every request.
+        """
+        ServerProxy.objects.create(proxy_name='test_server_proxy', server=self.test_server)
+        with mock.patch('server.outbound.get', wraps=outbound.get) as outbound_get:
+            for i in range(3):
+                self.client.get(reverse('server:proxy', kwargs={'proxy_name': 'test_server_proxy', 'user_query': ''}))
+        self.assertEqual(outbound_get.call_count, 3)
+
+
+def call_asgi(application, path, method='GET'):
+    return call_asgi_concurrently(application, [path], method)[0]
+
+
+def call_asgi_concurrently(application, paths, method='GET'):
+    """
+    Runs one request per path through application at the same time on a fresh event loop.
+    """
+    from . import async_proxy
+
+    async def call(path):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        await application({'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'headers': []}, receive, send)
+        start, body = messages
+        return start['status'], dict(start['headers']), body['body']
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        responses = loop.run_until_complete(asyncio.gather(*[call(path) for path in paths]))
+        loop.run_until_complete(async_proxy.close_client())
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+    return responses
+
+
+class RoutingTableTests(TestCase):
+    def setUp(self):
+        routing_table.clear()
+        # Keep the shared table from re-checking the routing version in the middle of a test
+        interval_settings = self.settings(SERVER_ROUTING_VERSION_CHECK_INTERVAL=60)
+        interval_settings.enable()
+        self.addCleanup(interval_settings.disable)
+        first_shard = Shard.objects.create(name='Shard A')
+        first_region = Region.objects.create(name='Region A', shard=first_shard)
+        first_agent = Agent.objects.create(name='First Agent', uuid='41f94400-2a3e-408a-9b80-1774724f62af', shard=first_shard)
+        self.test_server = Server.objects.create(
+            object_key='00000000-0000-0000-0000-000000000001',
+            object_name='Server A',
+            type=Server.TYPE_DEFAULT,
+            shard=first_shard,
+            region=first_region,
+            owner=first_agent,
+            address='http://example.com/a',
+            private_token='11111111111111111111111111111111',
+            public_token='10101010101010101010101010101010',
+            position_x=4.44,
+            position_y=5.55,
+            position_z=6.66,
+            enabled=False
+        )
+        self.test_server_proxy = ServerProxy.objects.create(proxy_name='test_server_proxy', server=self.test_server, forced_path='?path=/Map/', allow_user_query=True)
+
+    def test_lookup(self):
+        """
+        Known proxies must resolve without queries after the first lookup (the route and the version check), and
+        unknown ones must raise like get().
+        """
+        table = RoutingTable(check_interval=60)
+        with self.assertNumQueries(2):
+            route = table.lookup('test_server_proxy')
+        self.assertEqual(route.get_url('Custom'), self.test_server_proxy.get_url('Custom'))
+        with self.assertNumQueries(0):
+            self.assertEqual(table.lookup('test_server_proxy'), route)
+        with self.assertRaises(ServerProxy.DoesNotExist):
+            table.lookup('unknown')
+
+    def test_signal_invalidation(self):
+        """
+        Saving or deleting a proxy or moving its server must drop the cached routes.
+        """
+        routing_table.lookup('test_server_proxy')
+        self.test_server.address = 'http://example.com/b'
+        self.test_server.save()
+        self.assertEqual(routing_table.lookup('test_server_proxy').address, 'http://example.com/b')
+
+        self.test_server_proxy.forced_path = None
+        self.test_server_proxy.save()
+        self.assertEqual(routing_table.lookup('test_server_proxy').get_url('Custom'), 'http://example.com/bCustom')
+
+        # Saves that don't touch the address keep the table
+        self.test_server.save(update_fields=['enabled'])
+        Server.objects.get(pk=self.test_server.pk).save()
+        self.test_server.object_name = 'Renamed'
+        self.test_server.save()
+        with self.assertNumQueries(0):
+            routing_table.lookup('test_server_proxy')
+
+        self.test_server_proxy.delete()
+        with self.assertRaises(ServerProxy.DoesNotExist):
+            routing_table.lookup('test_server_proxy')
+
+    def test_version_invalidation(self):
+        """
+        An invalidation in another process must reach this one through the version row, with nothing else shared.
+        """
+        local_table = RoutingTable(check_interval=0)
+        other_process_table = RoutingTable(check_interval=0)
+        # Each "process" gets a cache of its own, as separate LocMemCache workers would
+        local_caches = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'local'}}
+        other_caches = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'other'}}
+
+        with self.settings(CACHES=local_caches):
+            local_table.lookup('test_server_proxy')
+        ServerProxy.objects.filter(pk=self.test_server_proxy.pk).update(allow_user_query=False)
+        with self.settings(CACHES=local_caches):
+            self.assertTrue(local_table.lookup('test_server_proxy').allow_user_query)
+
+        with self.settings(CACHES=other_caches):
+            other_process_table.invalidate()
+        with self.settings(CACHES=local_caches):
+            self.assertFalse(local_table.lookup('test_server_proxy').allow_user_query)
+
+    def test_eviction(self):
+        """
+        The least recently used route must be evicted once the table is full.
+        """
+        ServerProxy.objects.create(proxy_name='other_proxy', server=self.test_server)
+        table = RoutingTable(max_entries=1, check_interval=60)
+        table.lookup('test_server_proxy')
+        table.lookup('other_proxy')
+        self.assertEqual(list(table.routes), ['other_proxy'])
+
+
+class BreakerTests(TestCase):
+    def setUp(self):
+        self.breakers = BreakerRegistry(threshold=2, reset_timeout=60)
+
+    def call_failing(self, key):
+        with self.assertRaises(requests.ConnectionError):
+            self.breakers.call(key, mock.Mock(side_effect=requests.ConnectionError()))
+
+    def test_open_after_threshold(self):
+        """
+        The breaker must open after the threshold of consecutive failures and then fail fast without calling out.
+        """
+        self.call_failing(1)
+        self.assertEqual(self.breakers.call(1, lambda: 'OK'), 'OK')
+        self.call_failing(1)
+        self.call_failing(1)
+        self.assertEqual(self.breakers.states()[1]['state'], 'open')
+
+        upstream = mock.Mock()
+        with self.assertRaises(CircuitOpen):
+            self.breakers.call(1, upstream)
+        self.assertFalse(upstream.called)
+        self.assertEqual(self.breakers.call(2, lambda: 'OK'), 'OK')
+
+    def test_half_open(self):
+        """
+        Once the reset timeout passes exactly one trial call must go through, closing or reopening the breaker.
+        """
+        self.call_failing(1)
+        self.call_failing(1)
+        self.breakers.reset_timeout = 0
+
+        self.breakers.before_call(1)
+        self.assertEqual(self.breakers.states()[1]['state'], 'half-open')
+        with self.assertRaises(CircuitOpen):
+            self.breakers.before_call(1)
+        self.breakers.record_failure(1)
+        self.assertEqual(self.breakers.states()[1]['state'], 'open')
+
+        self.assertEqual(self.breakers.call(1, lambda: 'OK'), 'OK')
+        self.assertEqual(self.breakers.states(), {})
+
+    def test_proxy_fails_fast(self):
+        """
+        ProxyView must stop calling an unreachable server once its breaker opens.
+        """
+        first_shard = Shard.objects.create(name='Shard A')
+        first_region = Region.objects.create(name='Region A', shard=first_shard)
+        first_agent = Agent.objects.create(name='First Agent', uuid='41f94400-2a3e-408a-9b80-1774724f62af', shard=first_shard)
+        test_server = Server.objects.create(object_key='00000000-0000-0000-0000-000000000001', object_name='Server A',
+                                            type=Server.TYPE_DEFAULT, shard=first_shard, region=first_region, owner=first_agent,
+                                            address='http://127.0.0.1:1/', private_token='11111111111111111111111111111111',
+                                            public_token='10101010101010101010101010101010', position_x=4.44, position_y=5.55,
+                                            position_z=6.66, enabled=False)
+        ServerProxy.objects.create(proxy_name='test_server_proxy', server=test_server)
+        breakers.clear()
+        with self.settings(SERVER_BREAKER_THRESHOLD=2), mock.patch('server.outbound.get', wraps=outbound.get) as outbound_get:
+            for i in range(4):
+                response = self.client.get(reverse('server:proxy', kwargs={'proxy_name': 'test_server_proxy', 'user_query': ''}))
+                self.assertEqual(response.json(), {JSON_TAG_RESULT: JSON_RESULT_ERROR, JSON_TAG_MESSAGE: 'Unable to contact server'})
+        self.assertEqual(outbound_get.call_count, 2)
+
+        User.objects.create_user(username='staff', password='asdf', is_staff=True)
+        self.client.login(username='staff', password='asdf')
+        response = self.client.get(reverse('server:breakers'))
+        self.assertEqual(response.json()[JSON_TAG_MESSAGE][str(test_server.pk)]['state'], 'open')
+        breakers.clear()
+
+
+class OutboundMetricsTests(LiveServerTestCase):
+    def setUp(self):
+        outbound_metrics.clear()
+        breakers.clear()
+        self.user = User.objects.create_user(username='test_user', password='asdf')
+        first_shard = Shard.objects.create(name='Shard A')
+        first_region = Region.objects.create(name='Region A', shard=first_shard)
+        first_agent = Agent.objects.create(name='First Agent', uuid='41f94400-2a3e-408a-9b80-1774724f62af', shard=first_shard)
+        self.test_server = Server.objects.create(
+            object_key='00000000-0000-0000-0000-000000000001',
+            object_name='Server A',
+            type=Server.TYPE_DEFAULT,
+            shard=first_shard,
+            region=first_region,
+            owner=first_agent,
+            user=self.user,
+            address=self.live_server_url + reverse('server:debug_proxy', kwargs={'server_name': 'Server A'}),
+            private_token='11111111111111111111111111111111',
+            public_token='10101010101010101010101010101010',
+            position_x=4.44,
+            position_y=5.55,
+            position_z=6.66,
+            enabled=False
+        )
+
+    def test_proxy_metrics(self):
+        """
+        Proxied calls must be recorded per server and per proxy, with timeouts counted separately.
+        """
+        ServerProxy.objects.create(proxy_name='test_server_proxy', server=self.test_server)
+        for i in range(3):
+            self.client.get(reverse('server:proxy', kwargs={'proxy_name': 'test_server_proxy', 'user_query': ''}))
+        with mock.patch.object(outbound.get_session(), 'get', side_effect=requests.ReadTimeout()):
+            self.client.get(reverse('server:proxy', kwargs={'proxy_name': 'test_server_proxy', 'user_query': ''}))
+
+        self.client.login(username='test_user', password='asdf')
+        metrics = self.client.get(reverse('server:metrics')).json()[JSON_TAG_MESSAGE]
+        proxy_metrics = metrics['proxies']['test_server_proxy']
+        self.assertEqual(proxy_metrics['count'], 4)
+        self.assertEqual(proxy_metrics['status_codes'], {'200': 3})
+        self.assertEqual(proxy_metrics['timeouts'], 1)
+        self.assertEqual(proxy_metrics['errors'], 0)
+        self.assertEqual(proxy_metrics['buckets']['+Inf'], 4)
+        self.assertEqual(metrics['servers'][str(self.test_server.pk)]['count'], 4)
+
+        # Other users only see their own servers and proxies
+        User.objects.create_user(username='other_user', password='asdf')
+        self.client.login(username='other_user', password='asdf')
+        self.assertEqual(self.client.get(reverse('server:metrics')).json()[JSON_TAG_MESSAGE], {'servers': {}, 'proxies': {}})
+
+    def test_proxy_timeouts(self):
+        """
+        A proxy's own timeouts must override the global ones.
+        """
+        ServerProxy.objects.create(proxy_name='test_server_proxy', server=self.test_server, connect_timeout=1, read_timeout=2)
+        ServerProxy.objects.create(proxy_name='default_proxy', server=self.test_server)
+        with self.settings(SERVER_HTTP_CONNECT_TIMEOUT=3, SERVER_HTTP_READ_TIMEOUT=4):
+            with mock.patch('server.outbound.get', wraps=outbound.get) as outbound_get:
+                self.client.get(reverse('server:proxy', kwargs={'proxy_name': 'test_server_proxy', 'user_query': ''}))
+                self.client.get(reverse('server:proxy', kwargs={'proxy_name': 'default_proxy', 'user_query': ''}))
+        self.assertEqual([call[1]['timeout'] for call in outbound_get.call_args_list], [(1, 2), (3, 4)])
+
+
+class InternCacheTests(TestCase):
+    def test_resolve(self):
+        """
+        Resolved keys must be cached with LRU eviction and survive get_or_create losing a creation race.
+        """
+        cache = InternCache(max_entries=2)
+        shard_id = cache.resolve(('shard', 'Shard A'), Shard, name='Shard A')
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.resolve(('shard', 'Shard A'), Shard, name='Shard A'), shard_id)
+
+        cache.resolve(('shard', 'Shard B'), Shard, name='Shard B')
+        cache.resolve(('shard', 'Shard C'), Shard, name='Shard C')
+        self.assertIsNone(cache.get(('shard', 'Shard A')))
+
+        with mock.patch.object(Shard.objects, 'get_or_create', side_effect=IntegrityError()):
+            self.assertEqual(cache.resolve(('shard', 'Shard A'), Shard, name='Shard A'), shard_id)
+
+    def test_invalidation(self):
+        """
+        Editing or deleting an interned row must clear the cache.
+        """
+        intern_cache.clear()
+        shard_id, region_id, owner_id = resolve_location('Shard A', 'Region A', 'First Agent', '41f94400-2a3e-408a-9b80-1774724f62af')
+        self.assertEqual(intern_cache.get(('shard', 'Shard A')), shard_id)
+        Shard.objects.create(name='Shard B')
+        self.assertEqual(intern_cache.get(('shard', 'Shard A')), shard_id)
+
+        region = Region.objects.get(pk=region_id)
+        region.name = 'Region B'
+        region.save()
+        self.assertIsNone(intern_cache.get(('shard', 'Shard A')))
+
+
+@skipUnless(aiohttp, 'aiohttp is not installed')
+class AsyncProxyTests(LiveServerTestCase):
+    def setUp(self):
+        from . import async_proxy
+        self.async_proxy = async_proxy
+        breakers.clear()
+        proxy_cache.clear()
+        self.application = async_proxy.make_application()
+        first_shard = Shard.objects.create(name='Shard A')
+        first_region = Region.objects.create(name='Region A', shard=first_shard)
+        first_agent = Agent.objects.create(name='First Agent', uuid='41f94400-2a3e-408a-9b80-1774724f62af', shard=first_shard)
+        self.test_server = Server.objects.create(
+            object_key='00000000-0000-0000-0000-000000000001',
+            object_name='Server A',
+            type=Server.TYPE_DEFAULT,
+            shard=first_shard,
+            region=first_region,
+            owner=first_agent,
+            address=self.live_server_url + reverse('server:debug_proxy', kwargs={'server_name': 'Server A'}),
+            private_token='11111111111111111111111111111111',
+            public_token='10101010101010101010101010101010',
+            position_x=4.44,
+            position_y=5.55,
+            position_z=6.66,
+            enabled=False
+        )
+
+    def test_proxy_forced_address_and_userquery(self):
+        """
+        The async proxy must request the same upstream path as ProxyView and pass the response through.
+        """
+        test_server_proxy = ServerProxy.objects.create(
+            proxy_name='test_server_proxy',
+            server=self.test_server,
+            forced_path='?path=/Map/',
+            allow_user_query=True
+        )
+        status, headers, body = call_asgi(self.application, reverse('server:proxy', kwargs={
+            'proxy_name': test_server_proxy.proxy_name,
+            'user_query': 'Custom'
+        }))
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'content-type'], b'application/json')
+        self.assertEqual(json.loads(body.decode('utf-8')), {
+            'path': reverse('server:debug_proxy', kwargs={'server_name': test_server_proxy.server.object_name}) + '?path=/Map/Custom'
+        })
+
+    def test_proxy_errors(self):
+        """
+        Unknown proxies and unreachable servers must return the same JSON errors as ProxyView.
+        """
+        status, headers, body = call_asgi(self.application, reverse('server:proxy', kwargs={'proxy_name': 'unknown', 'user_query': ''}))
+        self.assertTrue(is_json_error(json.loads(body.decode('utf-8'))))
+
+        self.test_server.address = 'http://127.0.0.1:1/'
+        self.test_server.save()
+        ServerProxy.objects.create(proxy_name='test_server_proxy', server=self.test_server)
+        status, headers, body = call_asgi(self.application, reverse('server:proxy', kwargs={'proxy_name': 'test_server_proxy', 'user_query': ''}))
+        self.assertTrue(is_json_error(json.loads(body.decode('utf-8'))))
+
+    def test_response_too_large(self):
+        """
+        Upstream bodies over SERVER_PROXY_MAX_RESPONSE_SIZE must be cut off with the same error as ProxyView.
+        """
+        ServerProxy.objects.create(proxy_name='test_server_proxy', server=self.test_server, forced_path='?path=/Map/')
+        path = reverse('server:proxy', kwargs={'proxy_name': 'test_server_proxy', 'user_query': ''})
+        with self.settings(SERVER_PROXY_MAX_RESPONSE_SIZE=10):
+            status, headers, body = call_asgi(self.application, path)
+            self.assertEqual(json.loads(body.decode('utf-8')), json_error('Response too large'))
+        self.assertEqual(breakers.states(), {})
+
+        status, headers, body = call_asgi(self.application, path)
+        self.assertTrue('path' in json.loads(body.decode('utf-8')))
+
+    def test_cached_proxy(self):
+        """
+        Proxies with a cache TTL must serve repeated async requests from the cache, like ProxyView.
+        """
+        ServerProxy.objects.create(proxy_name='test_server_proxy', server=self.test_server, cache_ttl=60)
+        path = reverse('server:proxy', kwargs={'proxy_name': 'test_server_proxy', 'user_query': ''})
+        calls = []
+
+        async def fetch(url, timeout=None):
+            calls.append(url)
+            return 200, 'text/plain', 'Hello {}'.format(len(calls)).encode('utf-8')
+
+        with mock.patch('server.async_proxy.fetch', fetch):
+            for i in range(3):
+                status, headers, body = call_asgi(self.application, path)
+                self.assertEqual(body, b'Hello 1')
+            self.assertEqual(len(calls), 1)
+
+        # Errors are not cached
+        proxy_cache.clear()
+        self.test_server.address = 'http://127.0.0.1:1/'
+        self.test_server.save()
+        for i in range(2):
+            status, headers, body = call_asgi(self.application, path)
+            self.assertTrue(is_json_error(json.loads(body.decode('utf-8'))))
+        self.assertEqual(len(proxy_cache.entries), 0)
+
+    def test_concurrent_requests_coalesced(self):
+        """
+        Concurrent requests for the same upstream path must share one upstream call.
+        """
+        ServerProxy.objects.create(proxy_name='test_server_proxy', server=self.test_server)
+        path = reverse('server:proxy', kwargs={'proxy_name': 'test_server_proxy', 'user_query': ''})
+        calls = []
+
+        # Hold every request at the route lookup until all of them have got there
+        arrived = threading.Barrier(5, timeout=5)
+        get_route = self.async_proxy.get_route
+
+        def get_route_together(proxy_name):
+            route = get_route(proxy_name)
+            arrived.wait()
+            return route
+
+        async def fetch(url, timeout=None):
+            calls.append(url)
+            await asyncio.sleep(0.1)
+            return 200, 'text/plain', b'Hello'
+
+        with mock.patch('server.async_proxy.get_route', get_route_together), mock.patch('server.async_proxy.fetch', fetch):
+            responses = call_asgi_concurrently(self.application, [path] * 5)
+            self.assertEqual(len(calls), 1)
+            self.assertEqual([body for status, headers, body in responses], [b'Hello'] * 5)
+
+            with self.settings(SERVER_PROXY_COALESCE=False):
+                del calls[:]
+                call_asgi_concurrently(self.application, [path] * 5)
+                self.assertEqual(len(calls), 5)
+
+    def test_cancelled_trial(self):
+        """
+        Cancelling the upstream call during a half-open trial must give the trial back rather than leave it claimed.
+        """
+        ServerProxy.objects.create(proxy_name='test_server_proxy', server=self.test_server)
+        route = routing_table.lookup('test_server_proxy')
+        started = []
+
+        async def fetch(url, timeout=None):
+            started.append(url)
+            await asyncio.sleep(60)
+
+        async def cancel_trial():
+            task = asyncio.ensure_future(self.async_proxy.call_upstream(route, route.get_url('')))
+            while not started:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with self.settings(SERVER_BREAKER_THRESHOLD=1, SERVER_BREAKER_RESET_TIMEOUT=0), mock.patch('server.async_proxy.fetch', fetch):
+            breakers.record_failure(self.test_server.pk)
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(cancel_trial())
+            finally:
+                loop.close()
+
+            self.assertEqual(breakers.states()[self.test_server.pk]['state'], 'half-open')
+            # The trial is free again
+            breakers.before_call(self.test_server.pk)
+
+    def test_non_proxy_requests(self):
+        """
+        Other routes must 404 without a fallback application, and only GET may be proxied.
+        """
+        ServerProxy.objects.create(proxy_name='test_server_proxy', server=self.test_server)
+        status, headers, body = call_asgi(self.application, reverse('server:index'))
+        self.assertEqual(status, 404)
+        status, headers, body = call_asgi(self.application, reverse('server:proxy', kwargs={'proxy_name': 'test_server_proxy', 'user_query': ''}), method='POST')
+        self.assertEqual(status, 405)
+
+
+@skipUnless(aiohttp, 'aiohttp is not installed')
+class BenchmarkProxyCommandTests(TransactionTestCase):
+    def setUp(self):
+        breakers.clear()
+        routing_table.clear()
+        outbound_metrics.clear()
+
+    def test_benchmark(self):
+        """
+        The benchmark must push every request through both ProxyView and the ASGI application and clean up after itself.
+        """
+        output = io.StringIO()
+        call_command('benchmark_proxy', requests=5, delay=0, workers=2, stdout=output)
+        output = output.getvalue()
+        self.assertIn('ProxyView (2 workers): 5 requests', output)
+        self.assertIn('ASGI: 5 requests', output)
+        # Both paths went through the proxy's breaker and metrics, one upstream call per request
+        self.assertEqual([series['count'] for series in outbound_metrics.snapshot()['servers'].values()], [10])
+        self.assertFalse(ServerProxy.objects.exists())
+        self.assertFalse(Server.objects.exists())
+        self.assertFalse(Shard.objects.exists())
+
+
+class OutboundTests(TestCase):
+    def test_shared_session(self):
+        """
+        Outbound calls must share one pooled session, rebuilt when the pool settings change.
+        """
+        session = outbound.get_session()
+        self.assertIs(outbound.get_session(), session)
+        self.assertFalse(session.verify)
+
+        with self.settings(SERVER_HTTP_POOL_SIZE=3, SERVER_HTTP_CONNECT_TIMEOUT=1, SERVER_HTTP_READ_TIMEOUT=2):
+            pooled_session = outbound.get_session()
+            self.assertIsNot(pooled_session, session)
+            self.assertEqual(pooled_session.get_adapter('https://example.com/')._pool_maxsize, 3)
+            self.assertEqual(outbound.get_timeout(), (1, 2))
+        self.assertIsNot(outbound.get_session(), pooled_session)
+
+
+class SingleFlightTests(TestCase):
+    def run_concurrently(self, flights, key, fn, num_callers):
+        results = []
+        errors = []
+
+        def call():
+            try:
+                results.append(flights.do(key, fn))
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=call) for i in range(num_callers)]
+        for thread in threads:
+            thread.start()
+        return threads, results, errors
+
+    def join_barrier(self, num_waiters):
+        """
+        Returns a barrier the test passes once num_waiters callers are blocked waiting on a leader's flight.
+        """
+        barrier = threading.Barrier(num_waiters + 1, timeout=5)
+
+        class JoinedEvent(threading.Event):
+            def wait(self, timeout=None):
+                barrier.wait()
+                return super(JoinedEvent, self).wait(timeout)
+
+        class JoinedCall(singleflight.Call):
+            def __init__(self):
+                super(JoinedCall, self).__init__()
+                self.event = JoinedEvent()
+
+        patcher = mock.patch('server.singleflight.Call', JoinedCall)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return barrier
+
+    def test_concurrent_calls_share_one_result(self):
+        """
+        Concurrent calls with the same key must run the function once and all receive its result.
+        """
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait()
+            return 200, 'text/plain', 'Hello'
+
+        joined = self.join_barrier(4)
+        threads, results, errors = self.run_concurrently(flights, 'key', fetch, 5)
+        joined.wait()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [(200, 'text/plain', 'Hello')] * 5)
+        self.assertEqual(errors, [])
+        self.assertEqual(flights.calls, {})
+
+        # Finished flights are not reused
+        self.assertEqual(flights.do('key', lambda: 'Again'), 'Again')
+
+    def test_concurrent_calls_share_one_error(self):
+        """
+        Every waiter must see the leader's exception rather than retrying the call.
+        """
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait()
+            raise requests.ConnectionError('Unreachable')
+
+        joined = self.join_barrier(2)
+        threads, results, errors = self.run_concurrently(flights, 'key', fetch, 3)
+        joined.wait()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(all(isinstance(error, requests.ConnectionError) for error in errors))
+
+    def test_cache_flight(self):
+        """
+        A process that loses the cache lock must wait for the leader's published result instead of calling upstream.
+        """
+        cache = LocMemCache('singleflight-tests', {})
+        cache_flight = CacheSingleFlight(cache, timeout=5)
+        self.assertEqual(cache_flight.do('key', lambda: 'Leader'), 'Leader')
+        self.assertEqual(cache.get('singleflight:lock:' + hashlib.sha1(repr('key').encode('utf-8')).hexdigest()), None)
+
+        # Simulate a leader in another process that holds the lock and publishes after a short delay
+        other_process = CacheSingleFlight(cache, timeout=5)
+        release = threading.Event()
+        leader = threading.Thread(target=other_process.do, args=('key', lambda: release.wait() and 'Remote'))
+        leader.start()
+        for i in range(200):
+            if len(cache._cache) > 0:
+                break
+            threading.Event().wait(0.01)
+
+        threading.Timer(0.1, release.set).start()
+        self.assertEqual(cache_flight.do('key', lambda: self.fail('Waiter called upstream')), 'Remote')
+        leader.join()
+
+    def test_cache_flight_leader_failure(self):
+        """
+        Waiters must fall back to calling the function themselves when the leader releases the lock without a result.
+        """
+        cache = LocMemCache('singleflight-tests-failure', {})
+        other_process = CacheSingleFlight(cache, timeout=5)
+        release = threading.Event()
+
+        def failing_fetch():
+            release.wait()
+            raise requests.ConnectionError('Unreachable')
+
+        leader = threading.Thread(target=lambda: self.assertRaises(requests.ConnectionError, other_process.do, 'key', failing_fetch))
+        leader.start()
+        for i in range(200):
+            if len(cache._cache) > 0:
+                break
+            threading.Event().wait(0.01)
+
+        threading.Timer(0.1, release.set).start()
+        self.assertEqual(CacheSingleFlight(cache, timeout=5).do('key', lambda: 'Fallback'), 'Fallback')
+        leader.join()
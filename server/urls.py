@@ -13,7 +13,11 @@ urlpatterns = [
     url(r'^debug/confirm/(?P<server_name>.+)$', views.DebugConfirmView.as_view(), name='debug_confirm'),
     url(r'^register/$', views.RegisterView.as_view(), name='register'),
     url(r'^update/$', views.UpdateView.as_view(), name='update'),
+    url(r'^update/bulk/$', views.BulkUpdateView.as_view(), name='bulk_update'),
     url(r'^proxy/(?P<proxy_name>[^/]+)/(?P<user_query>.*)?', views.ProxyView.as_view(), name='proxy'),
+    url(r'^status/$', views.BulkStatusView.as_view(), name='bulk_status'),
+    url(r'^breakers/$', views.BreakersView.as_view(), name='breakers'),
+    url(r'^metrics/$', views.MetricsView.as_view(), name='metrics'),
     url(r'^create_proxy/$', views.CreateProxyView.as_view(), name='create_proxy'),
     url(r'^{}/$'.format(pattern_public_token), views.ServerView.as_view(), name='view'),
     url(r'^{}/confirm/$'.format(pattern_private_token), views.ConfirmView.as_view(), name='confirm'),
@@ -1,11 +1,26 @@
-from django.db import IntegrityError
-from django.http import JsonResponse, HttpResponse
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils import timezone
 from django.views import generic
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 from .models import *
+from . import health, outbound
+from .breaker import CircuitOpen, breakers
+from .heartbeats import MOVED_SERVER_FIELDS, heartbeat_buffer, reset_moved_servers
+from .interning import resolve_location
+from .metrics import outbound_metrics
+from .proxy_cache import proxy_cache
+from .routing import routing_table
+from .singleflight import coalesce
+import json
 import requests
 import logging
+from collections import OrderedDict
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
@@ -64,57 +79,69 @@ class RegisterView(generic.View):
         if not all(value is not None for key, value in headers.items()):
             return JsonResponse(json_error('One or more missing META arguments'))
 
-        shard, created = Shard.objects.get_or_create(name=headers['shard'])
-        region, created = Region.objects.get_or_create(shard=shard, name=headers['region'])
-        owner, created = Agent.objects.get_or_create(shard=shard, name=headers['owner_name'], uuid=headers['owner_key'])
-        private_token = Server.generate_private_token()
-        public_token = Server.generate_public_token()
-
-        if private_token is None or public_token is None:
-            return JsonResponse(json_error('Failed to generate auth tokens'))
+        shard_id, region_id, owner_id = resolve_location(headers['shard'], headers['region'], headers['owner_name'], headers['owner_key'])
 
         try:
-            existing_server = Server.objects.filter(object_key=headers['object_key']).first()
-            if existing_server is not None:
-                if existing_server.type != Server.TYPE_UNREGISTERED:
+            server = Server.objects.filter(object_key=headers['object_key']).first()
+            if server is not None:
+                if server.type != Server.TYPE_UNREGISTERED:
                     return JsonResponse(json_error('Server already registered'))
                 else:
-                    existing_server.type = Server.TYPE_UNREGISTERED
-                    existing_server.shard = shard
-                    existing_server.region = region
-                    existing_server.owner = owner
-                    existing_server.user = None
-                    existing_server.address = address
-                    existing_server.private_token = private_token
-                    existing_server.public_token = public_token
-                    existing_server.object_name = headers['object_name']
-                    existing_server.position_x = headers['position_x']
-                    existing_server.position_y = headers['position_y']
-                    existing_server.position_z = headers['position_z']
-                    existing_server.enabled = False
-                    existing_server.save()
+                    server.type = Server.TYPE_UNREGISTERED
+                    server.shard_id = shard_id
+                    server.region_id = region_id
+                    server.owner_id = owner_id
+                    server.user = None
+                    server.address = address
+                    server.object_name = headers['object_name']
+                    server.position_x = headers['position_x']
+                    server.position_y = headers['position_y']
+                    server.position_z = headers['position_z']
+                    server.enabled = False
             else:
-                Server.objects.create(
+                server = Server(
                     object_key=headers['object_key'],
                     object_name=headers['object_name'],
                     type=Server.TYPE_UNREGISTERED,
-                    shard=shard,
-                    region=region,
-                    owner=owner,
+                    shard_id=shard_id,
+                    region_id=region_id,
+                    owner_id=owner_id,
                     user=None,
                     address=address,
-                    private_token=private_token,
-                    public_token=public_token,
                     position_x=headers['position_x'],
                     position_y=headers['position_y'],
                     position_z=headers['position_z'],
                     enabled=False
                 )
+
+            # Tokens are unique columns, so the write itself is the collision check
+            if not server.save_with_new_tokens():
+                return JsonResponse(json_error('Failed to generate auth tokens'))
         except Exception as ex:
             logging.exception("Failed to create server")
             return JsonResponse(json_error('Failed to create server'))
 
-        return JsonResponse(json_success(private_token))
+        return JsonResponse(json_success(server.private_token))
+
+
+def find_server_for_update(private_token, object_key):
+    """
+    Returns (server, None) if private_token and object_key identify a registered server, or (None, error message).
+    """
+    if Server.objects.filter(object_key=object_key).count() == 0:
+        return None, 'Object not registered.'
+
+    try:
+        server = Server.objects.get(private_token=private_token, object_key=object_key)
+    except Server.DoesNotExist:
+        return None, 'Server does not exist'
+    except Server.MultipleObjectsReturned:
+        logging.exception("Multiple objects returned")
+        return None, 'Multiple servers contain the same token'
+
+    if server.type == Server.TYPE_UNREGISTERED:
+        return None, 'Server not registered'
+    return server, None
 
 
 @method_decorator(csrf_exempt, name='dispatch')
@@ -133,28 +160,155 @@ class UpdateView(generic.View):
         if not all(value is not None for key, value in headers.items()):
             return JsonResponse(json_error('One or more missing META arguments'))
 
-        if Server.objects.filter(object_key=headers['object_key']).count() == 0:
-            return JsonResponse(json_error('Object not registered.'))
-
         try:
-            server = Server.objects.get(private_token=private_token, object_key=headers['object_key'])
-        except Server.DoesNotExist:
-            return JsonResponse(json_error('Server does not exist'))
-        except Server.MultipleObjectsReturned:
-            logging.exception("Multiple objects returned")
-            return JsonResponse(json_error('Multiple servers contain the same token'))
+            URLValidator()(address)
+            position = [float(headers[key]) for key in ['position_x', 'position_y', 'position_z']]
+        except (ValidationError, ValueError):
+            return JsonResponse(json_error('Invalid arguments'))
+
+        heartbeat = {
+            'object_name': headers['object_name'],
+            'position_x': position[0],
+            'position_y': position[1],
+            'position_z': position[2],
+            'updated_on': timezone.now(),
+        }
+
+        if getattr(settings, 'SERVER_HEARTBEAT_WRITE_BEHIND', False):
+            server, error = find_server_for_update(private_token, headers['object_key'])
+            if server is None:
+                return JsonResponse(json_error(error))
+            heartbeat_buffer.add(server.pk, dict(heartbeat, address=address), moved=server.address != address)
+            return JsonResponse(json_success('OK'))
+
+        # Authenticate and write in one statement. The common case is an unchanged address, which only touches the
+        # heartbeat columns; an address change takes a second statement and the lookups only run on failure.
+        authorized = Server.objects.filter(private_token=private_token, object_key=headers['object_key']).exclude(type=Server.TYPE_UNREGISTERED)
+        if authorized.filter(address=address).update(**heartbeat):
+            return JsonResponse(json_success('OK'))
+
+        if authorized.update(address=address, **dict(heartbeat, **MOVED_SERVER_FIELDS)):
+            reset_moved_servers(authorized.values_list('pk', flat=True))
+            return JsonResponse(json_success('OK'))
+
+        server, error = find_server_for_update(private_token, headers['object_key'])
+        return JsonResponse(json_error(error or 'Server does not exist'))
+
+
+def parse_heartbeat_item(item):
+    """
+    Validates one bulk heartbeat item, an object with object_key, private_token, address, position as [x, y, z] and
+    optionally object_name. Returns (fields, None) or (None, error message).
+    """
+    if not isinstance(item, dict) or not all(item.get(key) is not None for key in ['object_key', 'private_token', 'address', 'position']):
+        return None, 'One or more missing arguments'
+    if not all(isinstance(item[key], str) for key in ['object_key', 'private_token', 'address']):
+        return None, 'Invalid arguments'
+    try:
+        URLValidator()(item['address'])
+        position_x, position_y, position_z = [float(value) for value in item['position']]
+    except (ValidationError, ValueError, TypeError):
+        return None, 'Invalid arguments'
+    return {
+        'object_key': item['object_key'],
+        'private_token': item['private_token'],
+        'address': item['address'],
+        'object_name': item.get('object_name'),
+        'position_x': position_x,
+        'position_y': position_y,
+        'position_z': position_z,
+    }, None
 
-        if server.type == Server.TYPE_UNREGISTERED:
-            return JsonResponse(json_error('Server not registered'))
 
-        server.object_name = headers['object_name']
-        server.address = address
-        server.position_x = headers['position_x']
-        server.position_y = headers['position_y']
-        server.position_z = headers['position_z']
-        server.save()
+def case_by_pk(values, field, output_field):
+    # One CASE over the primary key, leaving servers without a value for this field untouched
+    whens = [When(pk=pk, then=Value(value)) for pk, value in values.items()]
+    return Case(*whens, default=F(field), output_field=output_field)
 
-        return JsonResponse(json_success('OK'))
+
+@method_decorator(csrf_exempt, name='dispatch')
+class BulkUpdateView(generic.View):
+    def post(self, request):
+        try:
+            items = json.loads(request.body.decode('utf-8'))
+        except ValueError:
+            return JsonResponse(json_error('Invalid JSON'))
+        if not isinstance(items, list):
+            return JsonResponse(json_error('Expected a list of updates'))
+        max_items = getattr(settings, 'SERVER_BULK_UPDATE_MAX_ITEMS', 100)
+        if len(items) > max_items:
+            return JsonResponse(json_error('Too many updates (maximum {})'.format(max_items)))
+
+        results = [None] * len(items)
+        updates = []
+        for index, item in enumerate(items):
+            fields, error = parse_heartbeat_item(item)
+            if fields is None:
+                results[index] = json_error(error)
+            else:
+                updates.append((index, fields))
+
+        # One query authenticates every item and tells apart the failure reasons find_server_for_update reports
+        servers_by_token = {}
+        object_keys = set()
+        if updates:
+            tokens = [fields['private_token'] for index, fields in updates]
+            keys = [fields['object_key'] for index, fields in updates]
+            for server_id, private_token, object_key, server_type, address in Server.objects.filter(
+                    Q(private_token__in=tokens) | Q(object_key__in=keys)).values_list('pk', 'private_token', 'object_key', 'type', 'address'):
+                servers_by_token[private_token] = (server_id, object_key, server_type, address)
+                object_keys.add(object_key)
+
+        # Later items for the same server replace earlier ones, as with separate UpdateView calls
+        heartbeats = OrderedDict()
+        for index, fields in updates:
+            server = servers_by_token.get(fields['private_token'])
+            if fields['object_key'] not in object_keys:
+                results[index] = json_error('Object not registered.')
+            elif server is None or server[1] != fields['object_key']:
+                results[index] = json_error('Server does not exist')
+            elif server[2] == Server.TYPE_UNREGISTERED:
+                results[index] = json_error('Server not registered')
+            else:
+                heartbeats[server[0]] = (fields, server[3] != fields['address'])
+                results[index] = json_success('OK')
+
+        now = timezone.now()
+        if getattr(settings, 'SERVER_HEARTBEAT_WRITE_BEHIND', False):
+            for server_id, (fields, server_moved) in heartbeats.items():
+                heartbeat = {key: fields[key] for key in ['address', 'position_x', 'position_y', 'position_z']}
+                if fields['object_name'] is not None:
+                    heartbeat['object_name'] = fields['object_name']
+                heartbeat_buffer.add(server_id, dict(heartbeat, updated_on=now), moved=server_moved)
+        elif heartbeats:
+            moved = [server_id for server_id, (fields, server_moved) in heartbeats.items() if server_moved]
+            self.bulk_update(heartbeats, moved, now)
+            reset_moved_servers(moved)
+
+        return JsonResponse(json_success(results))
+
+    def bulk_update(self, heartbeats, moved, now):
+        server_ids = list(heartbeats)
+        batch_size = getattr(settings, 'SERVER_BULK_UPDATE_BATCH_SIZE', 50)
+        with transaction.atomic():
+            for start in range(0, len(server_ids), batch_size):
+                batch = server_ids[start:start + batch_size]
+                batch_moved = [server_id for server_id in batch if server_id in moved]
+                columns = {
+                    'address': case_by_pk({pk: heartbeats[pk][0]['address'] for pk in batch_moved}, 'address', models.URLField()),
+                    'object_name': case_by_pk({pk: heartbeats[pk][0]['object_name'] for pk in batch if heartbeats[pk][0]['object_name'] is not None},
+                                              'object_name', models.CharField()),
+                    'position_x': case_by_pk({pk: heartbeats[pk][0]['position_x'] for pk in batch}, 'position_x', models.FloatField()),
+                    'position_y': case_by_pk({pk: heartbeats[pk][0]['position_y'] for pk in batch}, 'position_y', models.FloatField()),
+                    'position_z': case_by_pk({pk: heartbeats[pk][0]['position_z'] for pk in batch}, 'position_z', models.FloatField()),
+                    'updated_on': now,
+                }
+                if batch_moved:
+                    for field, value in MOVED_SERVER_FIELDS.items():
+                        columns[field] = Case(When(pk__in=batch_moved, then=Value(value)), default=F(field), output_field=Server._meta.get_field(field))
+                # Skip CASE expressions that would only ever fall through to their default
+                columns = {field: value for field, value in columns.items() if not isinstance(value, Case) or value.cases}
+                Server.objects.filter(pk__in=batch).update(**columns)
 
 
 class ConfirmView(LoginRequiredMixin, generic.View):
@@ -175,7 +329,7 @@ class ConfirmView(LoginRequiredMixin, generic.View):
         else:
             try:
                 # Can we actually read from the server...
-                server_request = requests.get(server.address + "?path=/Base/InitComplete", verify=False)
+                server_request = outbound.get(server.address + "?path=/Base/InitComplete", server_id=server.pk)
                 status = server_request.status_code
                 if status != 200 or server_request.text != 'OK.':
                     return render(request, 'server/confirm.html', json_error('Unable to contact server.'))
@@ -223,16 +377,16 @@ class RegenerateTokensView(LoginRequiredMixin, generic.View):
             return JsonResponse(json_error('Server not registered'))
 
         if token_type == 'public':
-            server.regenerate_public_token()
+            token_fields = ['public_token']
         elif token_type == 'auth':
-            server.regenerate_private_token()
+            token_fields = ['private_token']
         elif token_type == 'both':
-            server.regenerate_private_token()
-            server.regenerate_public_token()
+            token_fields = ['private_token', 'public_token']
         else:
             return JsonResponse(json_error('Invalid token type specified'))
 
-        server.save()
+        if not server.save_with_new_tokens(token_fields):
+            return JsonResponse(json_error('Failed to generate auth tokens'))
         return JsonResponse(json_success('Successfully regenerated {} token(s)'.format(token_type)))
 
 
@@ -262,16 +416,70 @@ class StatusView(generic.View):
         if server.type == Server.TYPE_UNREGISTERED:
             return JsonResponse(json_error('Server not registered'))
 
-        try:
-            server_request = requests.get(server.address + "?path=/Base/Status", verify=False)
-            status = server_request.status_code
-            if status != 200 or server_request.text != 'OK.':
-                return JsonResponse(json_error('Server offline'))
-        except:
-            logging.exception("Failed to connect to server for StatusView")
-            return JsonResponse(json_error('Unable to contact server'))
+        if request.GET.get('live') == '1' or health.is_stale(server):
+            health.check_server(server)
+
+        if server.last_status == Server.STATUS_ONLINE:
+            return JsonResponse(json_success('Server online'))
+        elif server.last_status == Server.STATUS_OFFLINE:
+            return JsonResponse(json_error('Server offline'))
+        return JsonResponse(json_error('Unable to contact server'))
+
+
+class BulkStatusView(generic.View):
+    def get(self, request):
+        tokens = [token for token in request.GET.get('tokens', '').split(',') if token]
+        if tokens:
+            max_tokens = getattr(settings, 'SERVER_BULK_STATUS_MAX_TOKENS', 500)
+            if len(tokens) > max_tokens:
+                return JsonResponse(json_error('Too many tokens (maximum {})'.format(max_tokens)))
+            servers = Server.objects.filter(public_token__in=tokens)
+        elif request.user.is_authenticated:
+            servers = Server.objects.filter(user=request.user)
+        else:
+            return JsonResponse(json_error('One or more missing arguments'))
+
+        servers = list(servers)
+        registered = [server for server in servers if server.type != Server.TYPE_UNREGISTERED]
+        # Live probes are limited to the caller's own servers; everyone else gets the stored state unless it's stale
+        live = request.GET.get('live') == '1' and request.user.is_authenticated
+        deadline = getattr(settings, 'SERVER_BULK_STATUS_TIMEOUT', 5)
+        health.check_all([server for server in registered
+                          if (live and server.user_id == request.user.pk) or health.is_stale(server)],
+                         timeout=deadline, deadline=deadline)
+        # Servers whose probe didn't finish in time are reported with their stored state
+
+        statuses = {token: {'status': 'invalid'} for token in tokens}
+        for server in servers:
+            if server.type == Server.TYPE_UNREGISTERED:
+                statuses[server.public_token] = {'status': 'unregistered'}
+            else:
+                statuses[server.public_token] = {
+                    'status': server.get_last_status_display().lower(),
+                    'latency': server.last_latency,
+                    'checked_on': server.last_checked_on,
+                }
+        return JsonResponse(json_success(statuses))
+
+
+class BreakersView(LoginRequiredMixin, generic.View):
+    def get(self, request):
+        states = breakers.states()
+        if not request.user.is_staff:
+            own_servers = set(Server.objects.filter(user=request.user, pk__in=list(states)).values_list('pk', flat=True))
+            states = {server_id: state for server_id, state in states.items() if server_id in own_servers}
+        return JsonResponse(json_success(states))
+
 
-        return JsonResponse(json_success('Server online'))
+class MetricsView(LoginRequiredMixin, generic.View):
+    def get(self, request):
+        metrics = outbound_metrics.snapshot()
+        if not request.user.is_staff:
+            own_servers = set(Server.objects.filter(user=request.user).values_list('pk', flat=True))
+            own_proxies = set(ServerProxy.objects.filter(server__user=request.user).values_list('proxy_name', flat=True))
+            metrics['servers'] = {server_id: series for server_id, series in metrics['servers'].items() if server_id in own_servers}
+            metrics['proxies'] = {proxy_name: series for proxy_name, series in metrics['proxies'].items() if proxy_name in own_proxies}
+        return JsonResponse(json_success(metrics))
 
 
 class CreateProxyView(LoginRequiredMixin, generic.View):
@@ -283,10 +491,27 @@ class CreateProxyView(LoginRequiredMixin, generic.View):
         proxy_name = request.POST.get('proxy_name')
         forced_path = request.POST.get('forced_path')
         allow_user_query = request.POST.get('allow_user_query')
+        cache_ttl = request.POST.get('cache_ttl', 0)
+        connect_timeout = request.POST.get('connect_timeout') or None
+        read_timeout = request.POST.get('read_timeout') or None
 
         if not all(item is not None for item in [public_token, proxy_name]):
             return JsonResponse(json_error('One or more missing arguments'))
 
+        try:
+            cache_ttl = int(cache_ttl)
+        except ValueError:
+            cache_ttl = -1
+        if cache_ttl < 0:
+            return JsonResponse(json_error('Invalid cache TTL'))
+
+        try:
+            connect_timeout, read_timeout = [None if timeout is None else float(timeout) for timeout in [connect_timeout, read_timeout]]
+        except ValueError:
+            return JsonResponse(json_error('Invalid timeout'))
+        if any(timeout is not None and not 0 < timeout <= 300 for timeout in [connect_timeout, read_timeout]):
+            return JsonResponse(json_error('Invalid timeout'))
+
         if allow_user_query is not None:
             allow_user_query = True
         else:
@@ -304,7 +529,8 @@ class CreateProxyView(LoginRequiredMixin, generic.View):
             return JsonResponse(json_error('Server not registered'))
 
         try:
-            server_proxy = ServerProxy.objects.create(proxy_name=proxy_name, server=server, forced_path=forced_path, allow_user_query=allow_user_query)
+            server_proxy = ServerProxy.objects.create(proxy_name=proxy_name, server=server, forced_path=forced_path, allow_user_query=allow_user_query, cache_ttl=cache_ttl,
+                                                      connect_timeout=connect_timeout, read_timeout=read_timeout)
         except ServerProxy.DoesNotExist:
             return JsonResponse(json_error('Server does not exist'))
         except ServerProxy.MultipleObjectsReturned:
@@ -319,10 +545,57 @@ class CreateProxyView(LoginRequiredMixin, generic.View):
         return JsonResponse(json_success(server_proxy.proxy_name + (server_proxy.forced_path or "")))
 
 
+def stream_upstream(server_request, max_size, chunk_size=65536):
+    received = 0
+    try:
+        for chunk in server_request.iter_content(chunk_size):
+            received += len(chunk)
+            if received > max_size:
+                # Headers are already sent, so all that can be done is to cut the body short
+                logging.error("Proxied response from %s exceeded %d bytes, truncating", server_request.url, max_size)
+                return
+            yield chunk
+    finally:
+        server_request.close()
+
+
+def parse_content_length(value):
+    # Malformed lengths are treated as missing; stream_upstream() still enforces the limit on the body itself
+    try:
+        content_length = int(value)
+    except (TypeError, ValueError):
+        return None
+    return content_length if content_length >= 0 else None
+
+
+def stream_proxy_response(route, full_path):
+    logging.debug("Streaming: " + full_path)
+    server_request = breakers.call(route.server_id, outbound.get, full_path, timeout=route.get_timeout(),
+                                   server_id=route.server_id, proxy_name=route.proxy_name, stream=True)
+    streaming = False
+    try:
+        max_size = getattr(settings, 'SERVER_PROXY_MAX_RESPONSE_SIZE', 10 * 1024 * 1024)
+        content_length = parse_content_length(server_request.headers.get('Content-Length'))
+        if content_length is not None and content_length > max_size:
+            return JsonResponse(json_error('Response too large'))
+
+        response = StreamingHttpResponse(stream_upstream(server_request, max_size), status=server_request.status_code,
+                                         content_type=server_request.headers.get('Content-Type', 'text/plain'))
+        # iter_content() undoes any Content-Encoding, after which the upstream length no longer applies
+        if content_length is not None and 'Content-Encoding' not in server_request.headers:
+            response['Content-Length'] = str(content_length)
+        streaming = True
+        return response
+    finally:
+        # Once streaming, stream_upstream() owns the connection and closes it; otherwise it goes back to the pool here
+        if not streaming:
+            server_request.close()
+
+
 class ProxyView(generic.View):
     def get(self, request, proxy_name, user_query):
         try:
-            server_proxy = ServerProxy.objects.get(proxy_name=proxy_name)
+            route = routing_table.lookup(proxy_name)
         except ServerProxy.DoesNotExist:
             return JsonResponse(json_error('Unknown proxy'))
         except ServerProxy.MultipleObjectsReturned:
@@ -330,15 +603,31 @@ class ProxyView(generic.View):
             return JsonResponse(json_error('Multiple proxies with the same name'))
 
         try:
-            full_path = server_proxy.server.address
-            if server_proxy.forced_path is not None:
-                full_path = full_path + server_proxy.forced_path
-            if server_proxy.allow_user_query:
-                full_path = full_path + user_query
-
-            logging.debug("Requesting: " + full_path)
-            server_request = requests.get(full_path, verify=False)
-            return HttpResponse(server_request.text, status=server_request.status_code, content_type=server_request.headers['Content-Type'])
+            full_path = route.get_url(user_query)
+            # Cached proxies need the whole body anyway, so they always take the buffered path
+            if getattr(settings, 'SERVER_PROXY_STREAMING', False) and not route.cache_ttl:
+                return stream_proxy_response(route, full_path)
+
+            def fetch():
+                logging.debug("Requesting: " + full_path)
+                server_request = breakers.call(route.server_id, outbound.get, full_path, timeout=route.get_timeout(),
+                                               server_id=route.server_id, proxy_name=route.proxy_name)
+                return server_request.status_code, server_request.headers['Content-Type'], server_request.text
+
+            if getattr(settings, 'SERVER_PROXY_COALESCE', True):
+                fetch_uncoalesced = fetch
+
+                def fetch():
+                    return coalesce(('proxy', full_path), fetch_uncoalesced)
+
+            if route.cache_ttl:
+                status, content_type, content = proxy_cache.get((proxy_name, full_path), route.cache_ttl, fetch)
+            else:
+                status, content_type, content = fetch()
+            return HttpResponse(content, status=status, content_type=content_type)
+        except CircuitOpen:
+            logging.debug("Circuit open for server %s, not proxying", route.server_id)
+            return JsonResponse(json_error('Unable to contact server'))
         except:
             logging.exception("Failed to connect to server for ProxyView")
             return JsonResponse(json_error('Unable to contact server'))
@@ -0,0 +1,26 @@
+"""
+ASGI config for slutils project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+
+The proxy route (/server/proxy/...) is served asynchronously so slow in-world scripts don't tie up workers.
+Everything else is handed to the WSGI application when asgiref is installed, and 404s otherwise.
+"""
+
+import os
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "slutils.settings")
+django.setup()
+
+from server.async_proxy import make_application
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    from django.core.wsgi import get_wsgi_application
+    fallback = WsgiToAsgi(get_wsgi_application())
+except ImportError:
+    fallback = None
+
+application = make_application(fallback)
@@ -132,4 +132,88 @@ ROOT_PATH = os.path.dirname(__file__)
 
 STATICFILES_DIRS = [
     os.path.join(ROOT_PATH, 'static')
-]
\ No newline at end of file
+]
+
+
+# Sounds
+
+# Stream /sounds/json/all/ in chunks rather than building the whole response in memory
+SOUNDS_ALL_JSON_STREAMING = False
+
+# Path of the shared, memory-mapped sound catalog used for random selection. Rebuilt after every import.
+# None keeps a per-process index loaded from the database instead.
+SOUNDS_CATALOG_SNAPSHOT = None
+
+# Upper bound on the number of sounds /sounds/json/random/batch/ returns per request
+SOUNDS_RANDOM_BATCH_MAX = 100
+
+# Upper bound on the number of sounds in a /sounds/json/playlist/ response
+SOUNDS_PLAYLIST_MAX_SOUNDS = 100
+
+# Page size (and maximum requested limit) for /sounds/json/sync/
+SOUNDS_SYNC_PAGE_SIZE = 1000
+
+# Bytes of a /sounds/json/import/ndjson/ upload kept in memory while it is received; larger uploads spill to a
+# temporary file
+SOUNDS_IMPORT_SPOOL_SIZE = 1024 * 1024
+
+
+# Server
+
+# Outbound HTTP to in-world servers: number of per-host pools kept, connections kept alive per host, and the
+# connect/read timeouts in seconds
+SERVER_HTTP_POOL_HOSTS = 100
+SERVER_HTTP_POOL_SIZE = 10
+SERVER_HTTP_CONNECT_TIMEOUT = 5
+SERVER_HTTP_READ_TIMEOUT = 30
+
+# Bulk heartbeat endpoint: maximum updates per request, and servers per bulk UPDATE statement (each server adds
+# a few parameters per column, so keep this within the database's parameter limit)
+SERVER_BULK_UPDATE_MAX_ITEMS = 100
+SERVER_BULK_UPDATE_BATCH_SIZE = 50
+
+# Maximum shard, region and agent keys RegisterView keeps per process
+SERVER_INTERN_CACHE_SIZE = 10000
+
+# Buffer UpdateView heartbeats in memory and write them in one transaction every SERVER_HEARTBEAT_FLUSH_INTERVAL
+# milliseconds instead of saving each one as it arrives
+SERVER_HEARTBEAT_WRITE_BEHIND = False
+SERVER_HEARTBEAT_FLUSH_INTERVAL = 500
+
+# Circuit breaker for outbound calls: consecutive failures before a server's calls start failing fast, and seconds
+# before a single trial call is let through again
+SERVER_BREAKER_THRESHOLD = 5
+SERVER_BREAKER_RESET_TIMEOUT = 30
+
+# Maximum simultaneous upstream connections for the asynchronous proxy served by slutils.asgi
+SERVER_ASYNC_HTTP_LIMIT = 1000
+
+# Maximum number of proxied responses kept per process for proxies with a cache TTL
+SERVER_PROXY_CACHE_SIZE = 1000
+
+# Proxy routing table: proxy names kept per process, and how often in seconds each process compares its table against
+# the routing version stored in the database
+SERVER_ROUTING_TABLE_SIZE = 1000
+SERVER_ROUTING_VERSION_CHECK_INTERVAL = 1
+
+# Stream uncached proxied responses through in chunks instead of buffering them, cutting off bodies larger than
+# SERVER_PROXY_MAX_RESPONSE_SIZE bytes
+SERVER_PROXY_STREAMING = False
+SERVER_PROXY_MAX_RESPONSE_SIZE = 10 * 1024 * 1024
+
+# Share one upstream request between concurrent identical proxy calls. Setting SERVER_PROXY_COALESCE_CACHE to a
+# cache alias also coalesces across processes using that cache as the lock.
+SERVER_PROXY_COALESCE = True
+SERVER_PROXY_COALESCE_CACHE = None
+
+# Background health checks (manage.py check_servers): seconds between rounds, probes in flight at once, and the age
+# in seconds after which the status views stop trusting the stored result and probe the server themselves
+SERVER_HEALTH_CHECK_INTERVAL = 60
+SERVER_HEALTH_CHECK_CONCURRENCY = 20
+SERVER_HEALTH_CHECK_MAX_AGE = 300
+
+# Bulk status endpoint: maximum public tokens per request, and the deadline in seconds for each server's probe,
+# counted from when it starts. Servers not probed in time keep their stored state. live=1 only re-probes the
+# caller's own servers.
+SERVER_BULK_STATUS_MAX_TOKENS = 500
+SERVER_BULK_STATUS_TIMEOUT = 5
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class SoundsConfig(AppConfig):
     name = 'sounds'
+
+    def ready(self):
+        # Connects the signal handlers that keep the random selection index fresh
+        from . import catalog
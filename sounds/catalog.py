@@ -0,0 +1,248 @@
+import array
+import bisect
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import random
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import CatalogVersion, Sound
+
+
+SNAPSHOT_MAGIC = b'SLSC'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<4sII')
+
+
+class SoundIndex(object):
+    """
+    Duration-sorted view of every sound. Random selection within a duration window is two binary searches and a
+    random offset instead of a COUNT and an OFFSET scan over the table.
+    """
+    def __init__(self, uuids, durations, stamp=None):
+        self.uuids = uuids
+        self.durations = durations
+        self.stamp = stamp
+
+    def __len__(self):
+        return len(self.durations)
+
+    def window(self, min_duration=None, max_duration=None):
+        lo = 0
+        hi = len(self.durations)
+        if min_duration is not None:
+            lo = bisect.bisect_left(self.durations, min_duration)
+        if max_duration is not None:
+            hi = bisect.bisect_right(self.durations, max_duration)
+        return lo, max(lo, hi)
+
+    def get(self, position):
+        return self.uuids[position], self.durations[position]
+
+    def random(self, min_duration=None, max_duration=None):
+        lo, hi = self.window(min_duration, max_duration)
+        if lo == hi:
+            return None
+        return self.get(random.randint(lo, hi - 1))
+
+    def sample(self, count, min_duration=None, max_duration=None):
+        # random.sample on a range picks distinct positions without materializing the window
+        lo, hi = self.window(min_duration, max_duration)
+        positions = random.sample(range(lo, hi), min(count, hi - lo))
+        return [self.get(position) for position in positions]
+
+    def playlist(self, target, tolerance, min_duration=None, max_duration=None, max_sounds=100, attempts=10):
+        """
+        Randomized greedy fill: keep adding random distinct sounds short enough to fit the remaining time, finishing
+        with one that lands within tolerance when such a sound exists. Retries a few times and returns the first
+        playlist within tolerance, or None.
+        """
+        lo, hi = self.window(min_duration, max_duration)
+        if lo == hi:
+            return None
+
+        for attempt in range(attempts):
+            chosen = []
+            chosen_positions = set()
+            total = 0.0
+            while target - total > tolerance and len(chosen) < max_sounds:
+                remaining = target - total
+                position = self._pick(lo, hi, remaining - tolerance, remaining + tolerance, chosen_positions)
+                if position is None:
+                    position = self._pick(lo, hi, None, remaining + tolerance, chosen_positions)
+                if position is None:
+                    break
+                chosen_positions.add(position)
+                chosen.append(self.get(position))
+                total += self.durations[position]
+
+            if abs(target - total) <= tolerance:
+                return chosen
+        return None
+
+    def _pick(self, lo, hi, min_duration, max_duration, exclude):
+        if min_duration is not None:
+            lo = bisect.bisect_left(self.durations, min_duration, lo, hi)
+        hi = bisect.bisect_right(self.durations, max_duration, lo, hi)
+        if lo >= hi:
+            return None
+        # Walk forward from a random start; at most len(exclude) positions can be skipped
+        start = random.randint(lo, hi - 1)
+        for offset in range(min(hi - lo, len(exclude) + 1)):
+            position = lo + (start - lo + offset) % (hi - lo)
+            if position not in exclude:
+                return position
+        return None
+
+
+class SnapshotIndex(SoundIndex):
+    """
+    SoundIndex backed by a memory-mapped catalog snapshot file, so every worker process shares the same pages.
+
+    File layout: header, then 16-byte binary uuids, then native float32 durations, both sorted by duration.
+    """
+    def __init__(self, path, stamp=None):
+        with open(path, 'rb') as snapshot_file:
+            self.mapping = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count = SNAPSHOT_HEADER.unpack_from(self.mapping)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('Invalid sound catalog snapshot: {}'.format(path))
+
+        uuids_start = SNAPSHOT_HEADER.size
+        durations_start = uuids_start + count * 16
+        view = memoryview(self.mapping)
+        super(SnapshotIndex, self).__init__(view[uuids_start:durations_start],
+                                            view[durations_start:durations_start + count * 4].cast('f'),
+                                            stamp)
+
+    def get(self, position):
+        sound_uuid = str(uuid.UUID(bytes=bytes(self.uuids[position * 16:(position + 1) * 16])))
+        # Trim the float32 representation error so 1.1 comes back as 1.1 rather than 1.100000023841858
+        return sound_uuid, float('{:.7g}'.format(self.durations[position]))
+
+
+def write_snapshot(path):
+    """
+    Writes the catalog snapshot to a temporary file next to path and atomically renames it into place. Workers that
+    still have the previous file mapped keep reading it until they notice the new one.
+    """
+    index = build_sound_index()
+    uuids = bytearray()
+    for sound_uuid in index.uuids:
+        uuids += uuid.UUID(sound_uuid).bytes
+    durations = array.array('f', index.durations)
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.sound_catalog')
+    try:
+        with os.fdopen(fd, 'wb') as snapshot_file:
+            snapshot_file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(index)))
+            snapshot_file.write(uuids)
+            snapshot_file.write(durations.tobytes())
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+
+def snapshot_stamp(path):
+    stat = os.stat(path)
+    return path, stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def current_stamp():
+    # A primary key lookup, so checking for changes costs the same however large the catalog is. Every writer has to
+    # go through invalidate_sound_index() for other processes to notice.
+    return CatalogVersion.objects.filter(pk=1).values_list('version', flat=True).first()
+
+
+def bump_catalog_version():
+    if not CatalogVersion.objects.filter(pk=1).update(version=F('version') + 1):
+        catalog_version, created = CatalogVersion.objects.get_or_create(pk=1, defaults={'version': 1})
+        if not created:
+            # Another process created the row first
+            CatalogVersion.objects.filter(pk=1).update(version=F('version') + 1)
+
+
+def build_sound_index(stamp=None):
+    uuids = []
+    durations = []
+    for sound_uuid, duration in Sound.objects.order_by('duration', 'id').values_list('uuid', 'duration').iterator():
+        uuids.append(sound_uuid)
+        durations.append(duration)
+    return SoundIndex(uuids, durations, stamp)
+
+
+def get_sound_index():
+    global _index
+
+    snapshot_path = getattr(settings, 'SOUNDS_CATALOG_SNAPSHOT', None)
+    if snapshot_path:
+        try:
+            stamp = snapshot_stamp(snapshot_path)
+        except FileNotFoundError:
+            write_snapshot(snapshot_path)
+            stamp = snapshot_stamp(snapshot_path)
+    else:
+        stamp = current_stamp()
+
+    index = _index
+    if index is not None and index.stamp == stamp:
+        return index
+
+    with _index_lock:
+        if _index is None or _index.stamp != stamp:
+            if snapshot_path:
+                _index = SnapshotIndex(snapshot_path, stamp)
+            else:
+                _index = build_sound_index(stamp)
+        return _index
+
+
+_pending = threading.local()
+
+
+def invalidate_sound_index():
+    """
+    Drops this process' index and, when a shared snapshot is configured, rebuilds it for every other worker. Both
+    wait until the current transaction commits, so rolled back rows are never published, and happen once no
+    matter how many times they were asked for within it. The catalog version is bumped right away, in the same
+    transaction as the change, so other processes see both at once.
+    """
+    bump_catalog_version()
+    _pending.rebuild = True
+    transaction.on_commit(_rebuild_sound_index)
+
+
+def _rebuild_sound_index():
+    # Every invalidation queues one of these; the first to run after the commit does the work for all of them
+    global _index
+    if not getattr(_pending, 'rebuild', False):
+        return
+    _pending.rebuild = False
+    _index = None
+
+    snapshot_path = getattr(settings, 'SOUNDS_CATALOG_SNAPSHOT', None)
+    if snapshot_path:
+        write_snapshot(snapshot_path)
+
+
+@receiver(post_save, sender=Sound)
+@receiver(post_delete, sender=Sound)
+def _on_sound_changed(sender, **kwargs):
+    invalidate_sound_index()
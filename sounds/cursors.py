@@ -0,0 +1,36 @@
+import datetime
+
+from django.db.models import Q
+from django.utils import timezone
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(created_on, pk):
+    """
+    Opaque, URL-safe keyset cursor for the (created_on, id) ordering: '<microseconds since epoch>_<id>'
+    """
+    delta = created_on - EPOCH
+    microseconds = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return '{}_{}'.format(microseconds, pk)
+
+
+def decode_cursor(cursor):
+    """
+    Inverse of encode_cursor. Raises ValueError on malformed cursors.
+    """
+    microseconds, pk = cursor.split('_')
+    try:
+        return EPOCH + datetime.timedelta(microseconds=int(microseconds)), int(pk)
+    except OverflowError:
+        # Outside the datetime range
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+
+
+def filter_after(queryset, created_on, pk):
+    # The redundant created_on__gte lets the database seek on the created_on index before applying the tie-break
+    return queryset.filter(created_on__gte=created_on).filter(Q(created_on__gt=created_on) | Q(id__gt=pk))
+
+
+def filter_before(queryset, created_on, pk):
+    return queryset.filter(created_on__lte=created_on).filter(Q(created_on__lt=created_on) | Q(id__lt=pk))
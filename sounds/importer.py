@@ -0,0 +1,59 @@
+import time
+
+from .models import Sound
+
+
+class SoundImporter(object):
+    """
+    Buffers incoming sound records and writes them out in fixed-size batches. Existing uuids are resolved with one
+    IN lookup per batch rather than one query per sound, so memory and query count are bounded by the batch size.
+    Callers are expected to wrap the import in a transaction.
+    """
+    batch_size = 500
+
+    def __init__(self, batch_size=None):
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.num_imported = 0
+        self.num_skipped = 0
+        self.timings = {'validate': 0.0, 'lookup': 0.0, 'write': 0.0}
+        self.pending = {}
+
+    def add(self, record):
+        start = time.perf_counter()
+        sound_uuid = record['uuid']
+        if sound_uuid in self.pending:
+            self.num_skipped += 1
+        else:
+            new_sound = Sound(uuid=sound_uuid, duration=record['duration'], created_on=record['created_on'])
+            # Uniqueness is checked per batch in flush(), so skip the per-row query validate_unique would run
+            new_sound.full_clean(validate_unique=False)
+            self.pending[sound_uuid] = new_sound
+        self.timings['validate'] += time.perf_counter() - start
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        start = time.perf_counter()
+        existing_uuids = set(Sound.objects.filter(uuid__in=list(self.pending)).values_list('uuid', flat=True))
+        new_sounds = [sound for sound_uuid, sound in self.pending.items() if sound_uuid not in existing_uuids]
+        self.timings['lookup'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        Sound.objects.bulk_create(new_sounds)
+        self.timings['write'] += time.perf_counter() - start
+
+        self.num_imported += len(new_sounds)
+        self.num_skipped += len(existing_uuids)
+        self.pending = {}
+
+    def result(self):
+        return {
+            'num_imported': self.num_imported,
+            'num_skipped': self.num_skipped,
+            'timings': self.timings,
+        }
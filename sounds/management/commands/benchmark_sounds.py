@@ -0,0 +1,95 @@
+import datetime
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from sounds.models import CatalogVersion, Sound
+
+INDEXED_FIELDS = ['duration', 'created_on']
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Seeds N sounds and times the sound view query patterns, printing their EXPLAIN output. Everything is ' \
+           'rolled back afterwards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=10000, help='Number of sounds to seed')
+        parser.add_argument('--repeat', type=int, default=20, help='Number of timed runs per query')
+        parser.add_argument('--compare', action='store_true', help='Repeat the run with the duration and created_on indexes dropped')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.seed(options['count'])
+                self.run_queries('With indexes', options['repeat'])
+                if options['compare']:
+                    self.drop_indexes()
+                    self.run_queries('Without indexes', options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    def seed(self, count):
+        start = timezone.now() - datetime.timedelta(days=365)
+        sounds = []
+        for i in range(count):
+            sounds.append(Sound(
+                uuid=str(uuid.uuid4()),
+                duration=round(random.uniform(0.1, 30.0), 3),
+                created_on=start + datetime.timedelta(seconds=random.randint(0, 365 * 86400))
+            ))
+        Sound.objects.bulk_create(sounds)
+        self.stdout.write('Seeded {} sounds'.format(count))
+
+    def get_queries(self):
+        middle = Sound.objects.order_by('created_on', 'id').values_list('created_on', 'id')[Sound.objects.count() // 2]
+        return [
+            ('RandomJsonView: duration window', Sound.objects.filter(duration__gte=5, duration__lte=10).values_list('id', flat=True)),
+            ('RandomJsonView: index stamp', CatalogVersion.objects.filter(pk=1).values_list('version', flat=True)),
+            ('RandomJsonView: index build', Sound.objects.order_by('duration', 'id').values_list('uuid', 'duration')),
+            ('AllJsonView', Sound.objects.order_by('id').values_list('uuid', flat=True)),
+            ('IndexView: first page', Sound.objects.order_by('created_on', 'id').only('uuid', 'duration', 'created_on')[:100]),
+            ('IndexView: keyset page', Sound.objects.order_by('created_on', 'id').only('uuid', 'duration', 'created_on').filter(
+                created_on__gte=middle[0]).filter(Q(created_on__gt=middle[0]) | Q(id__gt=middle[1]))[:100]),
+        ]
+
+    def run_queries(self, title, repeat):
+        self.stdout.write('')
+        self.stdout.write('== {} ({}) =='.format(title, connection.vendor))
+        for name, queryset in self.get_queries():
+            timings = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                list(queryset.all())
+                timings.append(time.perf_counter() - start)
+
+            self.stdout.write('{}: mean {:.3f} ms, min {:.3f} ms'.format(name, sum(timings) * 1000 / len(timings), min(timings) * 1000))
+            for line in self.explain(queryset):
+                self.stdout.write('    ' + line)
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+
+    def drop_indexes(self):
+        table = Sound._meta.db_table
+        columns = [Sound._meta.get_field(field_name).column for field_name in INDEXED_FIELDS]
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, table)
+
+        with connection.schema_editor() as editor:
+            for name, constraint in constraints.items():
+                if constraint['index'] and not constraint['unique'] and constraint['columns'] in [[column] for column in columns]:
+                    editor.execute(editor.sql_delete_index % {'table': editor.quote_name(table), 'name': editor.quote_name(name)})
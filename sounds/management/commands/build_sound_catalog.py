@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from sounds.catalog import write_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the memory-mapped sound catalog snapshot used by the random sound views'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='Snapshot path. Defaults to SOUNDS_CATALOG_SNAPSHOT.')
+
+    def handle(self, *args, **options):
+        path = options['path'] or getattr(settings, 'SOUNDS_CATALOG_SNAPSHOT', None)
+        if not path:
+            raise CommandError('No snapshot path given and SOUNDS_CATALOG_SNAPSHOT is not set')
+
+        write_snapshot(path)
+        self.stdout.write('Wrote sound catalog snapshot to {}'.format(path))
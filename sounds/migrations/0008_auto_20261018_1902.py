@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 19:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sounds', '0007_auto_20160903_1742'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sound',
+            name='created_on',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
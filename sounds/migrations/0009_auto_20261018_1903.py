@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 19:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sounds', '0008_auto_20261018_1902'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sound',
+            name='duration',
+            field=models.FloatField(db_index=True),
+        ),
+    ]
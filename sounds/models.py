@@ -17,5 +17,12 @@ class Sound(models.Model):
             code='invalid_uuid'
         ),
     ])
-    duration = models.FloatField()
-    created_on = models.DateTimeField()
+    duration = models.FloatField(db_index=True)
+    created_on = models.DateTimeField(db_index=True)
+
+
+class CatalogVersion(models.Model):
+    """
+    Single row counting saved changes to the sound catalog, so every process can tell when its index is stale.
+    """
+    version = models.PositiveIntegerField(default=0)
@@ -1,10 +1,19 @@
-from django.test import TestCase
-from django.db import IntegrityError
+from django.test import TestCase, TransactionTestCase
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from .models import Sound
+from .models import CatalogVersion, Sound
+from .catalog import get_sound_index, write_snapshot, snapshot_stamp, SnapshotIndex
+from .views import AllJsonView, IndexView
+from .cursors import encode_cursor, decode_cursor
+from django.core.management import call_command
+from io import StringIO
+from unittest import mock
 import json
 import gzip
+import os
+import tempfile
 
 
 def create_test_sounds():
@@ -107,6 +116,48 @@ class IndexViewTests(TestCase):
         self.assertSequenceEqual(response.context['sound_list'], sounds)
 
 
+    def test_index_view_keyset_pagination(self):
+        """
+        Following next and previous cursors must walk every sound exactly once in (created_on, id) order, one query per page
+        """
+        for i in range(10):
+            Sound.objects.create(uuid='00000000-0000-0000-0000-{:012x}'.format(i), duration=i, created_on='2016-08-17 20:49:5{}+00:00'.format(i % 4))
+        expected = list(Sound.objects.order_by('created_on', 'id'))
+
+        with mock.patch.object(IndexView, 'page_size', 3):
+            pages = []
+            get_data = {}
+            while True:
+                with self.assertNumQueries(1):
+                    response = self.client.get(reverse('sounds:index'), get_data)
+                self.assertEqual(response.status_code, 200)
+                pages.append(list(response.context['sound_list']))
+                self.assertEqual(response.context['previous_cursor'] is None, len(pages) == 1)
+                if response.context['next_cursor'] is None:
+                    break
+                get_data = {'after': response.context['next_cursor']}
+            self.assertEqual([len(page) for page in pages], [3, 3, 3, 1])
+            self.assertSequenceEqual([sound for page in pages for sound in page], expected)
+
+            backwards = []
+            previous_cursor = response.context['previous_cursor']
+            while previous_cursor is not None:
+                response = self.client.get(reverse('sounds:index'), {'before': previous_cursor})
+                backwards.insert(0, list(response.context['sound_list']))
+                self.assertIsNotNone(response.context['next_cursor'])
+                previous_cursor = response.context['previous_cursor']
+            self.assertEqual(backwards, pages[:-1])
+
+    def test_index_view_bad_cursor(self):
+        """
+        An index view with a malformed cursor must 404
+        """
+        for get_data in [{'after': 'foobar'}, {'before': '1_x'}, {'after': '99999999999999999999_1'},
+                         {'before': '-99999999999999999_1'}]:
+            response = self.client.get(reverse('sounds:index'), get_data)
+            self.assertEqual(response.status_code, 404)
+
+
 class AllViewTests(TestCase):
 
     def test_all_view_with_no_sounds(self):
@@ -135,6 +186,88 @@ class AllViewTests(TestCase):
         self.assertDictEqual(json_data, expected_json)
 
 
+    def test_all_view_streaming(self):
+        """
+        Streamed output must be byte-for-byte identical to the buffered output, with each chunk fetched on its own
+        """
+        for num_sounds in [0, 1, 3, 10]:
+            Sound.objects.all().delete()
+            for sound in create_test_sounds()[num_sounds:]:
+                sound.delete()
+            expected = self.client.get(reverse('sounds:all_json')).content
+
+            for chunk_size in [1, 2, 1000]:
+                with self.settings(SOUNDS_ALL_JSON_STREAMING=True), mock.patch.object(AllJsonView, 'chunk_size', chunk_size):
+                    response = self.client.get(reverse('sounds:all_json'))
+                    self.assertEqual(response.status_code, 200)
+                    self.assertTrue(response.streaming)
+                    self.assertEqual(response['Content-Type'], 'application/json')
+                    # One bounded query per chunk, plus the one that finds nothing left after a full chunk
+                    with self.assertNumQueries(num_sounds // chunk_size + 1):
+                        self.assertEqual(b''.join(response.streaming_content), expected)
+
+
+class SyncViewTests(TestCase):
+    def setUp(self):
+        # Several sounds share a created_on so pages must break ties on id
+        self.sounds = []
+        created_on = ['2016-08-17 20:49:53+00:00', '2016-08-17 20:49:51+00:00', '2016-08-17 20:49:52+00:00']
+        for i in range(9):
+            self.sounds.append(Sound.objects.create(uuid='00000000-0000-0000-0000-{:012x}'.format(i), duration=i, created_on=created_on[i % 3]))
+        self.expected_uuids = [sound.uuid for sound in Sound.objects.order_by('created_on', 'id')]
+
+    def test_cursor_round_trip(self):
+        """
+        Decoding an encoded cursor must return the original created_on and id
+        """
+        sound = Sound.objects.get(uuid=self.sounds[4].uuid)
+        self.assertEqual(decode_cursor(encode_cursor(sound.created_on, sound.id)), (sound.created_on, sound.id))
+
+    def test_sync_pages(self):
+        """
+        Following next_cursor must visit every sound exactly once in (created_on, id) order
+        """
+        for limit in [1, 2, 4, 100]:
+            uuids = []
+            cursor = None
+            for i in range(20):
+                get_data = {'limit': limit}
+                if cursor is not None:
+                    get_data['cursor'] = cursor
+                response = self.client.get(reverse('sounds:sync_json'), get_data)
+                self.assertEqual(response.status_code, 200)
+                json_data = response.json()
+                if not json_data['sounds']:
+                    self.assertEqual(json_data['next_cursor'], cursor)
+                    break
+                self.assertLessEqual(len(json_data['sounds']), limit)
+                uuids.extend(sound['uuid'] for sound in json_data['sounds'])
+                cursor = json_data['next_cursor']
+            self.assertEqual(uuids, self.expected_uuids)
+
+    def test_sync_new_sounds(self):
+        """
+        Sounds created after the cursor must be returned on the next sync
+        """
+        response = self.client.get(reverse('sounds:sync_json'))
+        cursor = response.json()['next_cursor']
+        self.assertEqual(len(response.json()['sounds']), 9)
+
+        new_sound = Sound.objects.create(uuid='41f94400-2a3e-408a-9b80-1774724f62af', duration=1.5, created_on='2016-08-18 20:49:53.123456+00:00')
+        response = self.client.get(reverse('sounds:sync_json'), {'cursor': cursor})
+        json_data = response.json()
+        self.assertEqual(json_data['sounds'], [{'uuid': new_sound.uuid, 'duration': 1.5, 'created_on': '2016-08-18T20:49:53.123456+00:00'}])
+
+    def test_sync_bad_parameters(self):
+        """
+        Sync view must 404 on a malformed cursor or limit
+        """
+        for get_data in [{'cursor': 'foobar'}, {'cursor': '123'}, {'cursor': 'a_b'}, {'limit': 'baz'}, {'limit': 0},
+                         {'cursor': '99999999999999999999_1'}, {'cursor': '-99999999999999999_1'}]:
+            response = self.client.get(reverse('sounds:sync_json'), get_data)
+            self.assertEqual(response.status_code, 404)
+
+
 class RandomViewTests(TestCase):
 
     def test_random_view_with_no_sounds(self):
@@ -223,6 +356,233 @@ class RandomViewTests(TestCase):
             self.assertEqual(response.status_code, 404)
 
 
+class RandomBatchViewTests(TestCase):
+    def test_random_batch_with_no_sounds(self):
+        """
+        Random batch view must 404 when no sounds are present.
+        """
+        response = self.client.get(reverse('sounds:random_batch_json'), {'count': 5})
+        self.assertEqual(response.status_code, 404)
+
+    def test_random_batch_distinct(self):
+        """
+        Random batch view must return the requested number of distinct sounds within the duration bounds
+        """
+        sounds = create_test_sounds()
+        response = self.client.get(reverse('sounds:random_batch_json'), {'count': 3, 'min_duration': 4, 'max_duration': 64})
+        self.assertEqual(response.status_code, 200)
+        json_sounds = response.json()['sounds']
+        self.assertEqual(len(json_sounds), 3)
+        self.assertEqual(len(set(sound['uuid'] for sound in json_sounds)), 3)
+        for json_sound in json_sounds:
+            self.assertIn(json_sound['duration'], [4, 8, 16, 32, 64])
+            self.assertEqual(Sound.objects.get(uuid=json_sound['uuid']).duration, json_sound['duration'])
+
+        response = self.client.get(reverse('sounds:random_batch_json'), {'count': 50})
+        json_sounds = response.json()['sounds']
+        self.assertEqual(sorted(sound['uuid'] for sound in json_sounds), sorted(sound.uuid for sound in sounds))
+
+        with self.settings(SOUNDS_RANDOM_BATCH_MAX=2):
+            response = self.client.get(reverse('sounds:random_batch_json'), {'count': 50})
+        self.assertEqual(len(response.json()['sounds']), 2)
+
+    def test_random_batch_bad_count(self):
+        """
+        Random batch view must 404 on a missing or invalid count
+        """
+        create_test_sounds()
+        for get_data in [{}, {'count': 'foobar'}, {'count': 0}, {'count': -1}]:
+            response = self.client.get(reverse('sounds:random_batch_json'), get_data)
+            self.assertEqual(response.status_code, 404)
+
+
+class PlaylistViewTests(TestCase):
+    def test_playlist_with_no_sounds(self):
+        """
+        Playlist view must 404 when no sounds are present.
+        """
+        response = self.client.get(reverse('sounds:playlist_json'), {'target': 60})
+        self.assertEqual(response.status_code, 404)
+
+    def test_playlist_fills_target(self):
+        """
+        Playlist view must return distinct sounds within the duration bounds whose total is within tolerance of the target
+        """
+        create_test_sounds()
+        for target, tolerance in [(1, 0), (3, 0), (15, 0), (1023, 0), (100, 50)]:
+            response = self.client.get(reverse('sounds:playlist_json'), {'target': target, 'tolerance': tolerance})
+            self.assertEqual(response.status_code, 200)
+            json_data = response.json()
+            durations = [sound['duration'] for sound in json_data['sounds']]
+            self.assertEqual(len(set(sound['uuid'] for sound in json_data['sounds'])), len(durations))
+            self.assertEqual(sum(durations), json_data['duration'])
+            self.assertLessEqual(abs(json_data['duration'] - target), tolerance)
+
+        response = self.client.get(reverse('sounds:playlist_json'), {'target': 12, 'tolerance': 0, 'min_duration': 4})
+        self.assertEqual(sorted(sound['duration'] for sound in response.json()['sounds']), [4, 8])
+
+    def test_playlist_unfillable(self):
+        """
+        Playlist view must 404 when the target cannot be reached
+        """
+        create_test_sounds()
+        for get_data in [{'target': 2000, 'tolerance': 0}, {'target': 3, 'tolerance': 0, 'min_duration': 2}, {'target': 1.5, 'tolerance': 0.1}]:
+            response = self.client.get(reverse('sounds:playlist_json'), get_data)
+            self.assertEqual(response.status_code, 404)
+
+    def test_playlist_bad_parameters(self):
+        """
+        Playlist view must 404 on a missing or invalid target or tolerance
+        """
+        create_test_sounds()
+        for get_data in [{}, {'target': 'foobar'}, {'target': 0}, {'target': 60, 'tolerance': -1}, {'target': 60, 'tolerance': 60}, {'target': 60, 'tolerance': 'baz'}]:
+            response = self.client.get(reverse('sounds:playlist_json'), get_data)
+            self.assertEqual(response.status_code, 404)
+
+
+class SoundIndexTests(TestCase):
+    def test_window(self):
+        """
+        The index window must cover exactly the sounds within the inclusive duration bounds
+        """
+        create_test_sounds()
+        index = get_sound_index()
+        self.assertEqual(len(index), 10)
+        self.assertEqual(index.window(), (0, 10))
+        self.assertEqual(index.window(4, 16), (2, 5))
+        self.assertEqual(index.window(3, 3), (2, 2))
+        self.assertEqual(index.window(min_duration=512), (9, 10))
+        self.assertEqual(index.window(max_duration=0), (0, 0))
+        self.assertEqual(index.window(100, 1), (7, 7))
+
+    def test_random_within_window(self):
+        """
+        Random selection must only return sounds within the requested duration window
+        """
+        create_test_sounds()
+        for i in range(50):
+            uuid, duration = get_sound_index().random(4, 16)
+            self.assertIn(duration, [4, 8, 16])
+            self.assertEqual(Sound.objects.get(uuid=uuid).duration, duration)
+        self.assertIsNone(get_sound_index().random(3, 3))
+
+    def test_index_refresh(self):
+        """
+        The index must pick up sounds added after it was built, including bulk imports
+        """
+        self.assertEqual(len(get_sound_index()), 0)
+        Sound.objects.create(uuid='41f94400-2a3e-408a-9b80-1774724f62af', duration=1, created_on='2016-08-17 20:49:53.123456+08:00')
+        self.assertEqual(len(get_sound_index()), 1)
+        post_data = {'sounds': [{'uuid': 'a7488bf2-fef3-4846-a898-fc60dea73dbb', 'duration': 2, 'created_on': '2016-08-17 20:49:53.123456+08:00'}]}
+        self.client.post(reverse('sounds:import_json'), gzip.compress(json.dumps(post_data).encode('utf-8')), content_type="application/json")
+        self.assertEqual(len(get_sound_index()), 2)
+
+    def test_index_stamp_query(self):
+        """
+        Checking a warm index for changes must be a single primary key lookup, whatever the size of the catalog
+        """
+        create_test_sounds()
+        get_sound_index()
+        with CaptureQueriesContext(connection) as queries:
+            get_sound_index()
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertIn(CatalogVersion._meta.db_table, queries.captured_queries[0]['sql'])
+        self.assertNotIn(Sound._meta.db_table, queries.captured_queries[0]['sql'])
+
+    def test_index_refresh_on_change(self):
+        """
+        The index must pick up deletes and duration edits, which don't raise the highest id
+        """
+        sounds = create_test_sounds()
+        self.assertEqual(len(get_sound_index()), 10)
+        sounds[0].delete()
+        self.assertEqual(len(get_sound_index()), 9)
+
+        sounds[1].duration = 3
+        sounds[1].save()
+        self.assertEqual(get_sound_index().random(3, 3), (sounds[1].uuid, 3))
+
+
+class SnapshotCatalogTests(TransactionTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.snapshot_path = os.path.join(self.temp_dir.name, 'sound_catalog.bin')
+        snapshot_settings = self.settings(SOUNDS_CATALOG_SNAPSHOT=self.snapshot_path)
+        snapshot_settings.enable()
+        self.addCleanup(snapshot_settings.disable)
+
+    def test_snapshot_matches_database(self):
+        """
+        The snapshot must hold every sound sorted by duration and serve random views from it
+        """
+        sounds = create_test_sounds()
+        index = get_sound_index()
+        self.assertIsInstance(index, SnapshotIndex)
+        self.assertEqual(len(index), len(sounds))
+        self.assertEqual(index.window(4, 16), (2, 5))
+        for position, sound in enumerate(sounds):
+            self.assertEqual(index.get(position), (sound.uuid, sound.duration))
+
+        response = self.client.get(reverse('sounds:random_json'), {'min_duration': 8, 'max_duration': 8})
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(response.json(), {'uuid': sounds[3].uuid, 'duration': 8})
+
+        response = self.client.get(reverse('sounds:random_json'), {'min_duration': 3, 'max_duration': 3})
+        self.assertEqual(response.status_code, 404)
+
+    def test_snapshot_durations(self):
+        """
+        Durations that float32 cannot represent exactly must still be returned as they were stored
+        """
+        new_sound = Sound.objects.create(uuid='41f94400-2a3e-408a-9b80-1774724f62af', duration=1.1, created_on='2016-08-17 20:49:53.123456+08:00')
+        response = self.client.get(reverse('sounds:random_json'))
+        self.assertDictEqual(response.json(), {'uuid': new_sound.uuid, 'duration': 1.1})
+
+    def test_snapshot_rebuilt_by_import(self):
+        """
+        Imports must atomically replace the snapshot, and workers must pick up the new file without restarting
+        """
+        self.assertEqual(len(get_sound_index()), 0)
+        old_stamp = snapshot_stamp(self.snapshot_path)
+
+        post_data = {'sounds': [{'uuid': '41f94400-2a3e-408a-9b80-1774724f62af', 'duration': 123, 'created_on': '2016-08-17 20:49:53.123456+08:00'}]}
+        compressed_json = gzip.compress(json.dumps(post_data).encode('utf-8'))
+        self.client.post(reverse('sounds:import_json'), compressed_json, content_type="application/json")
+        self.assertNotEqual(snapshot_stamp(self.snapshot_path), old_stamp)
+        self.assertEqual(get_sound_index().random(), ('41f94400-2a3e-408a-9b80-1774724f62af', 123))
+
+        # Another process rebuilding the snapshot
+        Sound.objects.bulk_create([Sound(uuid='a7488bf2-fef3-4846-a898-fc60dea73dbb', duration=234, created_on='2016-08-17 20:49:53.123456+08:00')])
+        write_snapshot(self.snapshot_path)
+        self.assertEqual(len(get_sound_index()), 2)
+        self.assertEqual(os.listdir(self.temp_dir.name), ['sound_catalog.bin'])
+
+    def test_snapshot_rebuilt_on_commit(self):
+        """
+        Changes must rebuild the snapshot once when their transaction commits, and not at all when it rolls back
+        """
+        sounds = create_test_sounds()
+        get_sound_index()
+
+        with mock.patch('sounds.catalog.write_snapshot') as write_snapshot_mock:
+            with transaction.atomic():
+                for sound in sounds[:3]:
+                    sound.delete()
+                self.assertFalse(write_snapshot_mock.called)
+            self.assertEqual(write_snapshot_mock.call_count, 1)
+
+            write_snapshot_mock.reset_mock()
+            try:
+                with transaction.atomic():
+                    sounds[3].delete()
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+            self.assertFalse(write_snapshot_mock.called)
+            self.assertEqual(Sound.objects.count(), len(sounds) - 3)
+
+
 class ImportViewTests(TestCase):
     def test_import_normal(self):
         """
@@ -244,7 +604,9 @@ class ImportViewTests(TestCase):
         self.assertEqual(Sound.objects.count(), num_expected)
 
         json_response = response.json()
-        self.assertDictEqual(json_response, {'num_imported': num_expected})
+        self.assertEqual(json_response['num_imported'], num_expected)
+        self.assertEqual(json_response['num_skipped'], num_duplicates)
+        self.assertEqual(set(json_response['timings']), {'parse', 'validate', 'lookup', 'write'})
 
         for sound in post_data['sounds']:
             found_sound = Sound.objects.filter(uuid=sound['uuid']).filter(duration=sound['duration']).filter(created_on=sound['created_on']).count()
@@ -271,12 +633,36 @@ class ImportViewTests(TestCase):
         self.assertEqual(Sound.objects.count(), num_expected)
 
         json_response = response.json()
-        self.assertDictEqual(json_response, {'num_imported': num_expected})
+        self.assertEqual(json_response['num_imported'], num_expected)
+        self.assertEqual(json_response['num_skipped'], num_duplicates)
+        self.assertEqual(set(json_response['timings']), {'parse', 'validate', 'lookup', 'write'})
 
         for sound in post_data['sounds']:
             found_sound = Sound.objects.filter(uuid=sound['uuid']).count()
             self.assertEqual(found_sound, 1)
 
+    def test_import_existing(self):
+        """
+        Sounds that already exist must be skipped. Existing uuids must be resolved in batches rather than per sound.
+        """
+        sounds = create_test_sounds()
+        post_data = {'sounds': []}
+        for sound in sounds:
+            post_data['sounds'].append({'uuid': sound.uuid, 'duration': sound.duration, 'created_on': '2016-08-17 20:49:53.123456+08:00'})
+        for i in range(1200):
+            post_data['sounds'].append({'uuid': '00000000-0000-0000-0000-{:012x}'.format(i), 'duration': i, 'created_on': '2016-08-17 20:49:53.123456+08:00'})
+
+        compressed_json = gzip.compress(json.dumps(post_data).encode('utf-8'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('sounds:import_json'), compressed_json, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(len(queries), 20)
+
+        json_response = response.json()
+        self.assertEqual(json_response['num_imported'], 1200)
+        self.assertEqual(json_response['num_skipped'], len(sounds))
+        self.assertEqual(Sound.objects.count(), 1200 + len(sounds))
+
     def test_import_empty(self):
         """
         Importing an empty list of sounds must succeed and not add any sounds.
@@ -313,3 +699,72 @@ class ImportViewTests(TestCase):
             self.assertEqual(Sound.objects.count(), 0)
             json_response = json.loads(response.content.decode('utf-8'))
             self.assertTrue('error' in json_response)
+
+
+class ImportNdjsonViewTests(TestCase):
+    def post_ndjson(self, lines):
+        compressed_ndjson = gzip.compress('\n'.join(lines).encode('utf-8'))
+        return self.client.post(reverse('sounds:import_ndjson'), compressed_ndjson, content_type="application/x-ndjson")
+
+    def test_import_normal(self):
+        """
+        Normal importing of newline-delimited sounds must succeed. Duplicates, including ones spanning batches, must be skipped.
+        """
+        sounds = []
+        for i in range(1200):
+            sounds.append({'uuid': '00000000-0000-0000-0000-{:012x}'.format(i), 'duration': i, 'created_on': '2016-08-17 20:49:53.123456+08:00'})
+        sounds.append(sounds[0])
+        sounds.append(sounds[-2])
+
+        lines = [json.dumps(sound) for sound in sounds]
+        lines.insert(10, '')
+        response = self.post_ndjson(lines + [''])
+        self.assertEqual(response.status_code, 200)
+
+        json_response = response.json()
+        self.assertEqual(json_response['num_imported'], 1200)
+        self.assertEqual(json_response['num_skipped'], 2)
+        self.assertEqual(Sound.objects.count(), 1200)
+        self.assertEqual(Sound.objects.get(uuid=sounds[5]['uuid']).duration, 5)
+
+    def test_import_invalid(self):
+        """
+        Importing invalid sounds must return an error and not add any sounds.
+        """
+        valid_sound = json.dumps({'uuid': '41f94400-2a3e-408a-9b80-1774724f62af', 'duration': 123, 'created_on': '2016-08-17 20:49:53.123456+08:00'})
+        bad_lines = [
+            'bananas',
+            json.dumps({}),
+            json.dumps({'uuid': 'a7488bf2-fef3-4846-a898-fc60dea73dbb', 'duration': 123}),
+            json.dumps({'uuid': 'Bad UUID', 'duration': 123, 'created_on': '2016-08-17 20:49:53.123456+08:00'}),
+        ]
+
+        for bad_line in bad_lines:
+            response = self.post_ndjson([valid_sound, bad_line])
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue('error' in response.json())
+            self.assertEqual(Sound.objects.count(), 0)
+
+        response = self.client.post(reverse('sounds:import_ndjson'), b'not gzip', content_type="application/x-ndjson")
+        self.assertTrue('error' in response.json())
+
+
+class BenchmarkCommandTests(TestCase):
+    def test_benchmark(self):
+        """
+        The benchmark must report every query pattern with and without indexes and leave no sounds behind
+        """
+        create_test_sounds()
+        output = StringIO()
+        call_command('benchmark_sounds', count=200, repeat=1, compare=True, stdout=output)
+        output = output.getvalue()
+        self.assertIn('== With indexes', output)
+        self.assertIn('== Without indexes', output)
+        self.assertEqual(output.count('IndexView: keyset page'), 2)
+        self.assertEqual(Sound.objects.count(), 10)
+
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Sound._meta.db_table).values()
+        indexed_columns = [constraint['columns'] for constraint in constraints if constraint['index']]
+        self.assertIn(['duration'], indexed_columns)
+        self.assertIn(['created_on'], indexed_columns)
@@ -7,6 +7,10 @@ app_name = 'sounds'
 urlpatterns = [
     url(r'^$', views.IndexView.as_view(), name='index'),
     url(r'^json/import/$', csrf_exempt(views.ImportJsonView.as_view()), name='import_json'),
+    url(r'^json/import/ndjson/$', csrf_exempt(views.ImportNdjsonView.as_view()), name='import_ndjson'),
     url(r'^json/random/$', views.RandomJsonView.as_view(), name='random_json'),
+    url(r'^json/random/batch/$', views.RandomBatchJsonView.as_view(), name='random_batch_json'),
+    url(r'^json/playlist/$', views.PlaylistJsonView.as_view(), name='playlist_json'),
     url(r'^json/all/$', views.AllJsonView.as_view(), name='all_json'),
+    url(r'^json/sync/$', views.SyncJsonView.as_view(), name='sync_json'),
 ]
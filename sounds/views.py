@@ -1,91 +1,272 @@
-from django.db import IntegrityError
-from django.http import Http404, JsonResponse
+from django.db import IntegrityError, transaction
+from django.conf import settings
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.views import generic
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from .models import Sound
-from random import randint
+from .catalog import get_sound_index, invalidate_sound_index
+from .importer import SoundImporter
+from .cursors import encode_cursor, decode_cursor, filter_after, filter_before
+import io
 import json
 import gzip
+import shutil
+import tempfile
+import time
 
 class IndexView(generic.ListView):
+    """
+    Keyset-paginated by (created_on, id) so deep pages cost the same as the first one. ?after=<cursor> and
+    ?before=<cursor> select the page following or preceding a cursor from the context.
+    """
+    template_name = 'sounds/sound_list.html'
+    context_object_name = 'sound_list'
+    page_size = 100
+
     def get_queryset(self):
-        return Sound.objects.all()[:100]
+        sounds = Sound.objects.only('uuid', 'duration', 'created_on')
+        after = self.request.GET.get('after')
+        before = self.request.GET.get('before')
+
+        try:
+            if before:
+                sounds = filter_before(sounds, *decode_cursor(before)).order_by('-created_on', '-id')
+            elif after:
+                sounds = filter_after(sounds, *decode_cursor(after)).order_by('created_on', 'id')
+            else:
+                sounds = sounds.order_by('created_on', 'id')
+        except ValueError:
+            raise Http404("Invalid cursor")
+
+        # Fetch one extra row to tell whether there is another page in the direction of travel
+        page = list(sounds[:self.page_size + 1])
+        has_more = len(page) > self.page_size
+        page = page[:self.page_size]
+
+        if before:
+            page.reverse()
+            self.has_previous, self.has_next = has_more, True
+        else:
+            self.has_previous, self.has_next = bool(after), has_more
+
+        return page
+
+    def get_context_data(self, **kwargs):
+        context = super(IndexView, self).get_context_data(**kwargs)
+        page = context['sound_list']
+        context['previous_cursor'] = None
+        context['next_cursor'] = None
+        if page and self.has_previous:
+            context['previous_cursor'] = encode_cursor(page[0].created_on, page[0].id)
+        if page and self.has_next:
+            context['next_cursor'] = encode_cursor(page[-1].created_on, page[-1].id)
+        return context
+
+
+def get_duration_bounds(request):
+    try:
+        min_duration = int(request.GET.get('min_duration'))
+    except:
+        min_duration = None
+    try:
+        max_duration = int(request.GET.get('max_duration'))
+    except:
+        max_duration = None
+    return min_duration, max_duration
 
 
 class RandomJsonView(generic.View):
     def get(self, request):
+        min_duration, max_duration = get_duration_bounds(request)
 
         try:
-            min_duration = int(request.GET.get('min_duration'))
-        except:
-            min_duration = None
-        try:
-            max_duration = int(request.GET.get('max_duration'))
+            random_sound = get_sound_index().random(min_duration, max_duration)
         except:
-            max_duration = None
+            raise Http404("Invalid parameters")
+
+        if random_sound is None:
+            raise Http404("No sounds available")
 
-        has_min_duration = isinstance(min_duration, int)
-        has_max_duration = isinstance(max_duration, int)
+        uuid, duration = random_sound
+        return JsonResponse({'uuid': uuid, 'duration': duration})
+
+
+class RandomBatchJsonView(generic.View):
+    def get(self, request):
+        min_duration, max_duration = get_duration_bounds(request)
+        max_count = getattr(settings, 'SOUNDS_RANDOM_BATCH_MAX', 100)
 
         try:
-            if has_min_duration and has_max_duration:
-                sounds = Sound.objects.filter(duration__lte=max_duration).filter(duration__gte=min_duration)
-            elif has_min_duration:
-                sounds = Sound.objects.filter(duration__gte=min_duration)
-            elif has_max_duration:
-                sounds = Sound.objects.filter(duration__lte=max_duration)
-            else:
-                sounds = Sound.objects.all()
+            count = int(request.GET.get('count'))
         except:
             raise Http404("Invalid parameters")
+        if count < 1:
+            raise Http404("Invalid parameters")
 
-        num_sounds = len(sounds)
+        try:
+            random_sounds = get_sound_index().sample(min(count, max_count), min_duration, max_duration)
+        except:
+            raise Http404("Invalid parameters")
 
-        if num_sounds == 0:
+        if len(random_sounds) == 0:
             raise Http404("No sounds available")
 
-        random_index = randint(0, num_sounds - 1)
-        random_sound = sounds[random_index]
+        return JsonResponse({'sounds': [{'uuid': uuid, 'duration': duration} for uuid, duration in random_sounds]})
+
 
-        return JsonResponse({'uuid': random_sound.uuid, 'duration': random_sound.duration})
+class PlaylistJsonView(generic.View):
+    def get(self, request):
+        min_duration, max_duration = get_duration_bounds(request)
+
+        try:
+            target = float(request.GET.get('target'))
+            tolerance = float(request.GET.get('tolerance', 1))
+        except:
+            raise Http404("Invalid parameters")
+        if not 0 <= tolerance < target:
+            raise Http404("Invalid parameters")
+
+        max_sounds = getattr(settings, 'SOUNDS_PLAYLIST_MAX_SOUNDS', 100)
+        try:
+            playlist = get_sound_index().playlist(target, tolerance, min_duration, max_duration, max_sounds=max_sounds)
+        except:
+            raise Http404("Invalid parameters")
+
+        if playlist is None:
+            raise Http404("Unable to fill playlist")
+
+        return JsonResponse({
+            'sounds': [{'uuid': uuid, 'duration': duration} for uuid, duration in playlist],
+            'duration': sum(duration for uuid, duration in playlist),
+        })
 
 
 class AllJsonView(generic.View):
+    chunk_size = 1000
+
     def get(self, request):
-        sounds = Sound.objects.all()
-        sounds_json = []
-        for sound in sounds:
-            sounds_json.append(sound.uuid)
+        if getattr(settings, 'SOUNDS_ALL_JSON_STREAMING', False):
+            return StreamingHttpResponse(self.stream_sounds(), content_type='application/json')
+
+        return JsonResponse({'sounds': list(Sound.objects.order_by('id').values_list('uuid', flat=True))})
+
+    def stream_sounds(self):
+        # Must stay byte-for-byte identical to the JsonResponse output above. Django 1.10 has no server-side cursors
+        # and iterator() still fetches the whole result, so each chunk is its own keyset query on id instead.
+        yield '{"sounds": ['
+        separator = ''
+        last_id = 0
+        while True:
+            chunk = list(Sound.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'uuid')[:self.chunk_size])
+            if not chunk:
+                break
+            yield separator + ', '.join(json.dumps(uuid) for sound_id, uuid in chunk)
+            separator = ', '
+            last_id = chunk[-1][0]
+            if len(chunk) < self.chunk_size:
+                break
+        yield ']}'
+
+
+class SyncJsonView(generic.View):
+    """
+    Incremental replication. Returns sounds created after the given (created_on, id) cursor in keyset-paginated pages
+    along with the cursor for the next page. Omitting the cursor starts from the beginning of the catalog.
+    """
+    def get(self, request):
+        cursor = request.GET.get('cursor')
+        page_size = getattr(settings, 'SOUNDS_SYNC_PAGE_SIZE', 1000)
+
+        try:
+            limit = min(int(request.GET.get('limit', page_size)), page_size)
+        except:
+            raise Http404("Invalid parameters")
+        if limit < 1:
+            raise Http404("Invalid parameters")
 
-        return JsonResponse({'sounds': sounds_json})
+        sounds = Sound.objects.order_by('created_on', 'id')
+        if cursor:
+            try:
+                created_on, pk = decode_cursor(cursor)
+            except ValueError:
+                raise Http404("Invalid cursor")
+            sounds = filter_after(sounds, created_on, pk)
+
+        page = list(sounds.values_list('id', 'uuid', 'duration', 'created_on')[:limit])
+        if page:
+            pk, uuid, duration, created_on = page[-1]
+            cursor = encode_cursor(created_on, pk)
+
+        return JsonResponse({
+            # isoformat() rather than DjangoJSONEncoder, which truncates to milliseconds and would lose the cursor's precision
+            'sounds': [{'uuid': uuid, 'duration': duration, 'created_on': created_on.isoformat()}
+                       for pk, uuid, duration, created_on in page],
+            'next_cursor': cursor,
+        })
 
 
 class ImportJsonView(generic.View):
     def post(self, request):
-        bulk_sounds = []
-        processed_uuids = set()
+        importer = SoundImporter()
 
         try:
+            start = time.perf_counter()
             decompressed_payload = gzip.decompress(request.body).decode('utf-8')
             json_data = json.loads(decompressed_payload)
-            for sound in json_data['sounds']:
-                sound_uuid = sound['uuid']
-                if sound_uuid not in processed_uuids:
-                    processed_uuids.add(sound_uuid)
-                    if Sound.objects.filter(uuid=sound_uuid).count() == 0:
-                        new_sound = Sound(uuid=sound_uuid, duration=sound['duration'], created_on=sound['created_on'])
-                        new_sound.full_clean()
-                        bulk_sounds.append(new_sound)
+            parse_time = time.perf_counter() - start
+
+            with transaction.atomic():
+                for sound in json_data['sounds']:
+                    importer.add(sound)
+                importer.flush()
+                # Part of the import's transaction, so other processes see the new catalog version with the sounds
+                invalidate_sound_index()
         except IntegrityError as ex:
-            return JsonResponse({'error': ex.message})
+            return JsonResponse({'error': str(ex)})
         except Exception as ex:
             return JsonResponse({'error': 'Error'})
 
-        try:
-            Sound.objects.bulk_create(bulk_sounds)
-        except Exception as ex:
-            return JsonResponse({'Error': 'Failed to bulk import sounds'})
+        result = importer.result()
+        result['timings']['parse'] = parse_time
+        return JsonResponse(result)
+
+
+class ImportNdjsonView(generic.View):
+    """
+    Streaming variant of ImportJsonView. Accepts gzip-compressed newline-delimited JSON, one sound per line, and
+    decompresses and parses it incrementally so memory use doesn't grow with the size of the upload. Large uploads
+    are spooled to a temporary file first.
+    """
+    def post(self, request):
+        importer = SoundImporter()
+        parse_time = 0.0
+
+        # Receive the whole (compressed) upload before opening the transaction, so a slow client doesn't hold the
+        # database write lock for as long as it takes to send
+        spool_size = getattr(settings, 'SOUNDS_IMPORT_SPOOL_SIZE', 1024 * 1024)
+        with tempfile.SpooledTemporaryFile(max_size=spool_size) as upload:
+            shutil.copyfileobj(request, upload)
+            upload.seek(0)
+
+            try:
+                with transaction.atomic():
+                    lines = io.TextIOWrapper(gzip.GzipFile(fileobj=upload, mode='rb'), encoding='utf-8')
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        start = time.perf_counter()
+                        sound = json.loads(line)
+                        parse_time += time.perf_counter() - start
+                        importer.add(sound)
+                    importer.flush()
+                    invalidate_sound_index()
+            except IntegrityError as ex:
+                return JsonResponse({'error': str(ex)})
+            except Exception as ex:
+                return JsonResponse({'error': 'Error'})
 
-        return JsonResponse({'num_imported': len(bulk_sounds)})
+        result = importer.result()
+        result['timings']['parse'] = parse_time
+        return JsonResponse(result)